@@ -0,0 +1,72 @@
+"""Benchmark the job output modes: ZIP (deflated vs stored) and one merged PDF.
+
+Personalizes a batch of synthetic same-template reports, then times each
+packaging mode and compares result sizes. By default every report has its
+own body image and text and only the logo is shared; --identical measures
+the best case of byte-identical reports.
+
+    python -m backend.bench_output --files 20 --pdf-kb 300 --logo-kb 60
+"""
+import argparse
+import logging
+import sys
+import time
+import zipfile
+from typing import List, Optional
+
+import backend.pdf_processing as pdf_processing
+from backend.loadtest import make_synthetic_pdf
+
+
+def time_output(processed_files: List[tuple], output_mode: str, compression: int, repeat: int) -> tuple:
+    """Best-of-N wall time and result size for one packaging mode."""
+    original = pdf_processing.ZIP_COMPRESSION
+    pdf_processing.ZIP_COMPRESSION = compression
+    try:
+        best = None
+        for _ in range(repeat):
+            started = time.perf_counter()
+            result_bytes, _, _ = pdf_processing.build_output(processed_files, output_mode)
+            elapsed = time.perf_counter() - started
+            best = elapsed if best is None else min(best, elapsed)
+        return best, len(result_bytes)
+    finally:
+        pdf_processing.ZIP_COMPRESSION = original
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Compare ZIP and merged-PDF output modes")
+    parser.add_argument("--files", type=int, default=20, help="Reports in the batch")
+    parser.add_argument("--pdf-kb", type=int, default=300, help="Approximate size of each synthetic PDF")
+    parser.add_argument("--logo-kb", type=int, default=60, help="Size of the logo image shared by every report")
+    parser.add_argument("--identical", action="store_true", help="Use byte-identical reports (best case for merging)")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per mode; the best time is reported")
+    args = parser.parse_args(argv)
+
+    logging.getLogger("backend").setLevel(logging.WARNING)
+
+    profile = {"name": "Bench Student", "roll": "1"}
+    processed_files = [
+        (f"report_{i}.pdf", pdf_processing.process_single_pdf(
+            make_synthetic_pdf(args.pdf_kb, seed=0 if args.identical else i, logo_kb=args.logo_kb), profile
+        ))
+        for i in range(args.files)
+    ]
+    input_bytes = sum(len(content) for _, content in processed_files)
+
+    modes = [
+        ("zip (deflated)", "zip", zipfile.ZIP_DEFLATED),
+        ("zip (stored)", "zip", zipfile.ZIP_STORED),
+        ("merged pdf", "merged", zipfile.ZIP_STORED),
+    ]
+    variant = "identical" if args.identical else f"unique bodies, shared {args.logo_kb} KB logo"
+    print(f"{args.files} processed reports ({variant}), {input_bytes / 1024:.0f} KB total")
+    print(f"{'mode':<16}{'time (ms)':>12}{'size (KB)':>12}{'vs input':>10}")
+    for label, output_mode, compression in modes:
+        elapsed, size = time_output(processed_files, output_mode, compression, args.repeat)
+        print(f"{label:<16}{elapsed * 1000:>12.1f}{size / 1024:>12.0f}{size / input_bytes:>10.1%}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,282 @@
+"""Load generator for the queue API.
+
+Simulates N concurrent users doing POST /api/queue, polling
+/api/status/{job_id} and downloading the result, using synthetic PDFs.
+Runs against the app in-process (httpx ASGITransport) by default, or
+against a running server with --url.
+
+    python -m backend.loadtest --users 30 --files 5 --pdf-kb 500
+    python -m backend.loadtest --url http://localhost:8000 --server-pid 1234
+"""
+import argparse
+import asyncio
+import json
+import logging
+import math
+import os
+import random
+import sys
+import time
+from typing import List, Optional
+
+import fitz  # PyMuPDF
+import httpx
+
+
+def make_synthetic_pdf(size_kb: int, seed: int = 0, logo_kb: int = 0) -> bytes:
+    """Build a lab-report-like PDF padded to roughly size_kb with incompressible image data.
+
+    The body image and text depend on seed. A logo_kb logo image, identical
+    for every seed, stands in for template artwork shared by a batch.
+    """
+    doc = fitz.open()
+    page = doc.new_page()
+    page.insert_text((50, 60), "Name: Sample Student", fontsize=12)
+    page.insert_text((50, 80), "Roll No: 00", fontsize=12)
+    page.insert_text((300, 80), "Div: A", fontsize=12)
+    page.insert_text((50, 100), "Experiment No: 1", fontsize=12)
+    page.insert_text((50, 700), f"Observations for report {seed}: reading {random.Random(seed).random():.4f}", fontsize=10)
+
+    if logo_kb:
+        side = max(int((logo_kb * 1024 / 3) ** 0.5), 1)
+        logo = fitz.Pixmap(fitz.csRGB, side, side, random.Random("logo").randbytes(side * side * 3), 0)
+        page.insert_image(fitz.Rect(450, 20, 545, 115), pixmap=logo)
+
+    header_only = len(doc.tobytes())
+    pad_bytes = max(size_kb * 1024 - header_only, 0)
+    if pad_bytes:
+        # Random RGB noise does not deflate, so the file really is this big
+        side = max(int((pad_bytes / 3) ** 0.5), 1)
+        samples = random.Random(seed).randbytes(side * side * 3)  # Seeded so runs are comparable
+        pix = fitz.Pixmap(fitz.csRGB, side, side, samples, 0)
+        page.insert_image(fitz.Rect(50, 150, 545, 645), pixmap=pix)
+
+    pdf_bytes = doc.tobytes()
+    doc.close()
+    return pdf_bytes
+
+
+def percentile(values: List[float], pct: float) -> float:
+    """Nearest-rank percentile; 0.0 for an empty list."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(math.ceil(pct / 100 * len(ordered)), 1)
+    return ordered[rank - 1]
+
+
+def proc_status_kb(pid: int, field: str) -> Optional[int]:
+    """A /proc/<pid>/status field in KB (e.g. VmRSS), None if the process is gone."""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def child_pids(pid: int) -> List[int]:
+    """All descendants of pid (PDF workers, the forkserver, ...), from /proc/<pid>/stat."""
+    parents = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                stat = f.read()
+        except OSError:
+            continue
+        ppid = int(stat.rsplit(")", 1)[1].split()[1])  # comm may contain spaces
+        parents.setdefault(ppid, []).append(int(entry))
+
+    found, pending = [], [pid]
+    while pending:
+        for child in parents.get(pending.pop(), []):
+            found.append(child)
+            pending.append(child)
+    return found
+
+
+async def sample_rss(server_pid: int, interval: float, peaks: dict, stop: asyncio.Event):
+    """Track peak RSS of the server's child processes, alone and summed with the server, until stopped."""
+    while not stop.is_set():
+        children = sum(proc_status_kb(pid, "VmRSS") or 0 for pid in child_pids(server_pid)) / 1024
+        server = (proc_status_kb(server_pid, "VmRSS") or 0) / 1024
+        peaks["workers"] = max(peaks.get("workers", 0.0), children)
+        peaks["total"] = max(peaks.get("total", 0.0), server + children)
+        try:
+            await asyncio.wait_for(stop.wait(), timeout=interval)
+        except asyncio.TimeoutError:
+            pass
+
+
+def peak_rss_mb(server_pid: Optional[int], sampled: dict) -> Optional[dict]:
+    """Peak RSS in MB of the server process, of its PDF worker processes, and of both together."""
+    if server_pid is None:
+        return None
+    server = (proc_status_kb(server_pid, "VmHWM") or 0) / 1024
+    return {
+        "server": round(server, 1),
+        "workers": round(sampled.get("workers", 0.0), 1),
+        "total": round(max(sampled.get("total", 0.0), server), 1),
+    }
+
+
+async def simulate_user(client: httpx.AsyncClient, user_id: int, args, pdfs: List[bytes], results: list):
+    """One user: submit, poll until done, download - repeated args.jobs_per_user times."""
+    for _ in range(args.jobs_per_user):
+        files = [("files", (f"report_{user_id}_{i}.pdf", pdf, "application/pdf")) for i, pdf in enumerate(pdfs)]
+        started = time.perf_counter()
+        outcome = {"user": user_id, "status": "error", "latency": None, "downloaded_bytes": 0}
+        try:
+            response = await client.post("/api/queue", files=files, data={"name": f"User {user_id}", "roll": str(user_id), "output": args.output})
+            response.raise_for_status()
+            job_id = response.json()["job_id"]
+
+            while True:
+                status = (await client.get(f"/api/status/{job_id}")).json()
+                if status["status"] in ["completed", "failed", "cancelled"]:
+                    break
+                await asyncio.sleep(args.poll_interval)
+
+            outcome["status"] = status["status"]
+            if status["status"] == "completed":
+                download = await client.get(status["download_url"])
+                download.raise_for_status()
+                outcome["downloaded_bytes"] = len(download.content)
+            outcome["latency"] = time.perf_counter() - started
+        except Exception as e:
+            outcome["error"] = str(e)
+        results.append(outcome)
+
+
+async def sample_queue(client: httpx.AsyncClient, interval: float, started: float, timeline: list, stop: asyncio.Event):
+    """Record queue depth and active jobs from /api/stats until stopped."""
+    while not stop.is_set():
+        try:
+            stats = (await client.get("/api/stats")).json()
+            timeline.append({
+                "t": round(time.perf_counter() - started, 2),
+                "queued": stats["queued_jobs"],
+                "active": stats["active_jobs"],
+            })
+        except Exception:
+            pass
+        try:
+            await asyncio.wait_for(stop.wait(), timeout=interval)
+        except asyncio.TimeoutError:
+            pass
+
+
+async def run_load(args) -> dict:
+    pdfs = [make_synthetic_pdf(args.pdf_kb, seed=i) for i in range(args.files)]
+    limits = httpx.Limits(max_connections=args.users * 2 + 4)
+    timeout = httpx.Timeout(args.timeout)
+
+    if args.url:
+        client = httpx.AsyncClient(base_url=args.url, limits=limits, timeout=timeout)
+        lifespan = None
+    else:
+        from backend.main import app, lifespan as app_lifespan
+        client = httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://loadtest", timeout=timeout)
+        lifespan = app_lifespan(app)
+
+    results: list = []
+    timeline: list = []
+    rss_peaks: dict = {}
+    stop = asyncio.Event()
+    # In-process the server is this process; over HTTP only if --server-pid is given
+    server_pid = args.server_pid if args.url else os.getpid()
+
+    async with client:
+        if lifespan is not None:
+            await lifespan.__aenter__()
+        try:
+            started = time.perf_counter()
+            samplers = [asyncio.create_task(sample_queue(client, args.sample_interval, started, timeline, stop))]
+            if server_pid is not None:
+                samplers.append(asyncio.create_task(sample_rss(server_pid, args.sample_interval, rss_peaks, stop)))
+            await asyncio.gather(*(simulate_user(client, u, args, pdfs, results) for u in range(args.users)))
+            elapsed = time.perf_counter() - started
+            stop.set()
+            await asyncio.gather(*samplers)
+        finally:
+            if lifespan is not None:
+                await lifespan.__aexit__(None, None, None)
+
+    latencies = [r["latency"] for r in results if r["status"] == "completed"]
+    completed = len(latencies)
+    return {
+        "config": {
+            "mode": "http" if args.url else "in-process",
+            "users": args.users,
+            "jobs_per_user": args.jobs_per_user,
+            "files_per_job": args.files,
+            "pdf_kb": args.pdf_kb,
+            "output": args.output,
+            "pdf_bytes_actual": [len(p) for p in pdfs],
+        },
+        "elapsed_s": round(elapsed, 3),
+        "jobs_completed": completed,
+        "jobs_failed": len(results) - completed,
+        "throughput_jobs_per_s": round(completed / elapsed, 3) if elapsed else 0.0,
+        "throughput_files_per_s": round(completed * args.files / elapsed, 3) if elapsed else 0.0,
+        "latency_s": {
+            "p50": round(percentile(latencies, 50), 3),
+            "p95": round(percentile(latencies, 95), 3),
+            "p99": round(percentile(latencies, 99), 3),
+            "max": round(max(latencies), 3) if latencies else 0.0,
+        },
+        "max_queue_depth": max((s["queued"] for s in timeline), default=0),
+        "queue_timeline": timeline,
+        "peak_rss_mb": peak_rss_mb(server_pid, rss_peaks),
+        "errors": [r.get("error") for r in results if r.get("error")][:10],
+    }
+
+
+def print_report(report: dict):
+    cfg = report["config"]
+    lat = report["latency_s"]
+    print(f"Mode: {cfg['mode']}  users={cfg['users']} jobs/user={cfg['jobs_per_user']} "
+          f"files/job={cfg['files_per_job']} pdf~{cfg['pdf_kb']}KB")
+    print(f"Elapsed: {report['elapsed_s']}s  completed={report['jobs_completed']} failed={report['jobs_failed']}")
+    print(f"Throughput: {report['throughput_jobs_per_s']} jobs/s, {report['throughput_files_per_s']} files/s")
+    print(f"End-to-end latency: p50={lat['p50']}s p95={lat['p95']}s p99={lat['p99']}s max={lat['max']}s")
+    print(f"Max queue depth: {report['max_queue_depth']}")
+    if report["peak_rss_mb"] is not None:
+        rss = report["peak_rss_mb"]
+        print(f"Peak RSS: server {rss['server']:.1f} MB, workers {rss['workers']:.1f} MB, total {rss['total']:.1f} MB")
+    for error in report["errors"]:
+        print(f"  error: {error}")
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Load test the PDF Personalizer queue API")
+    parser.add_argument("--url", help="Target a running server instead of the in-process app")
+    parser.add_argument("--server-pid", type=int, help="PID of the --url server, for peak RSS of it and its workers")
+    parser.add_argument("--users", type=int, default=10, help="Concurrent simulated users")
+    parser.add_argument("--jobs-per-user", type=int, default=1, help="Jobs each user submits in sequence")
+    parser.add_argument("--files", type=int, default=3, help="PDFs per job")
+    parser.add_argument("--pdf-kb", type=int, default=200, help="Approximate size of each synthetic PDF")
+    parser.add_argument("--output", choices=["zip", "merged"], default="zip", help="Result format to request")
+    parser.add_argument("--poll-interval", type=float, default=0.5, help="Seconds between status polls")
+    parser.add_argument("--sample-interval", type=float, default=0.5, help="Seconds between queue depth samples")
+    parser.add_argument("--timeout", type=float, default=120, help="HTTP timeout per request")
+    parser.add_argument("--json", dest="json_path", help="Also write the full report to this file")
+    args = parser.parse_args(argv)
+
+    # The app logs every span it touches; keep the report readable
+    logging.getLogger("backend").setLevel(logging.WARNING)
+
+    report = asyncio.run(run_load(args))
+    print_report(report)
+    if args.json_path:
+        with open(args.json_path, "w") as f:
+            json.dump(report, f, indent=2)
+    return 0 if report["jobs_failed"] == 0 else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,15 +1,16 @@
-from fastapi import FastAPI, UploadFile, File, Form, HTTPException, BackgroundTasks
+from fastapi import FastAPI, UploadFile, File, Form, Header, HTTPException, BackgroundTasks
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse, FileResponse, JSONResponse
+from fastapi.responses import StreamingResponse, FileResponse, JSONResponse, PlainTextResponse
 from fastapi.staticfiles import StaticFiles
 from typing import List, Optional, Dict
 from pathlib import Path
 from contextlib import asynccontextmanager
-import fitz  # PyMuPDF
-import re
 import io
-import zipfile
 import os
+import sys
+import random
+import hmac
+import multiprocessing
 import logging
 import asyncio
 import uuid
@@ -19,14 +20,23 @@ from datetime import datetime, timedelta
 BASE_DIR = Path(__file__).resolve().parent.parent
 FRONTEND_DIR = BASE_DIR / "frontend"
 
+if __package__ in (None, ""):
+    sys.path.insert(0, str(BASE_DIR))  # Run as a script: make the backend package importable
+
+from backend import pdf_worker
+from backend.pdf_processing import build_output, has_pdf_header, merge_job_profile, new_job_profile, parse_page_selection
+from backend.pdf_worker import PROCESSING_FAILED, PdfWorker
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """Lifespan event handler for starting background workers"""
     asyncio.create_task(queue_worker())
     asyncio.create_task(cleanup_old_jobs())
+    asyncio.create_task(cancel_abandoned_jobs())
     logger.info("Lifecycle: Background workers started")
     yield
     logger.info("Lifecycle: Application shutting down")
+    await stop_pdf_workers()
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -49,11 +59,24 @@ app.add_middleware(
 )
 
 # Constants
-HEADER_LIMIT_Y = 500  # Covers typical lab report headers including logos, tables, field rows
 MAX_FILE_SIZE = 10 * 1024 * 1024  # 10MB per file
 MAX_FILES = 20  # Maximum number of files per request
 MAX_CONCURRENT_JOBS = 5  # Maximum concurrent processing jobs
 JOB_RETENTION_TIME = 600  # 10 minutes in seconds
+OUTPUT_MODES = ["zip", "merged"]  # Separate PDFs in a ZIP, or everything merged into one PDF
+ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN")  # Enables admin-only features (job profiling) when set
+PROFILE_SAMPLE_RATE = float(os.environ.get("PROFILE_SAMPLE_RATE", 0))  # Fraction of jobs profiled automatically
+
+# Per-document budgets, enforced in isolated worker processes
+# Defaults fit a 512 MB host: the API process plus PDF_WORKERS x (~30-45 MB worker + FILE_MEMORY_LIMIT_MB)
+PDF_WORKERS = int(os.environ.get("PDF_WORKERS", 2))  # Max worker processes for PDF processing, started on demand
+FILE_CPU_LIMIT = int(os.environ.get("FILE_CPU_LIMIT", 30))  # CPU seconds per document (RLIMIT_CPU)
+FILE_MEMORY_LIMIT_MB = int(os.environ.get("FILE_MEMORY_LIMIT_MB", 160))  # Memory per document, on top of the idle worker (RLIMIT_AS)
+FILE_WALL_TIMEOUT = float(os.environ.get("FILE_WALL_TIMEOUT", 60))  # Wall-clock seconds before the worker is killed
+# Cancel jobs nobody has polled for this long (seconds). Generous because browsers throttle or
+# suspend timers in background tabs; closed tabs are cancelled right away by the page itself.
+JOB_IDLE_TIMEOUT = int(os.environ.get("JOB_IDLE_TIMEOUT", 600))
+JOB_IDLE_CHECK_INTERVAL = 5  # How often to look for abandoned jobs (seconds)
 
 # Queue System State
 jobs: Dict[str, dict] = {}  # job_id -> job_data
@@ -61,62 +84,294 @@ active_jobs = 0
 job_queue = asyncio.Queue()
 processing_lock = asyncio.Lock()
 total_files_processed = 100  # Starting count for social proof
+watchdog_stats = {
+    "cpu_limit_kills": 0,     # Worker killed by RLIMIT_CPU (SIGXCPU)
+    "memory_limit_kills": 0,  # Document hit the memory budget
+    "timeout_kills": 0,       # Worker killed after FILE_WALL_TIMEOUT
+    "worker_crashes": 0,      # Worker died for any other reason
+    "worker_respawns": 0,
+}
 
 # Helper Functions
 # ... (existing helper functions) ...
 
+
+def profile_to_speedscope(job_id: str, profile: dict) -> dict:
+    """Convert a job's collapsed stacks, weighted by measured time, to a speedscope 'sampled' profile."""
+    frames = []
+    frame_index = {}
+    samples = []
+    weights = []
+    for stack, seconds in profile["stack_seconds"].items():
+        sample = []
+        for name in stack.split(";"):
+            if name not in frame_index:
+                frame_index[name] = len(frames)
+                frames.append({"name": name})
+            sample.append(frame_index[name])
+        samples.append(sample)
+        weights.append(seconds)  # Measured time, not samples x interval: samples stall while MuPDF holds the GIL
+
+    return {
+        "$schema": "https://www.speedscope.app/file-format-schema.json",
+        "name": f"Job {job_id}",
+        "exporter": "pdf-personalizer",
+        "shared": {"frames": frames},
+        "profiles": [{
+            "type": "sampled",
+            "name": f"process_single_pdf ({job_id})",
+            "unit": "seconds",
+            "startValue": 0,
+            "endValue": sum(weights),
+            "samples": samples,
+            "weights": weights,
+        }],
+    }
+
+
+def is_admin(token: Optional[str]) -> bool:
+    """Check an X-Admin-Token value; admin features are off unless ADMIN_TOKEN is set."""
+    return bool(ADMIN_TOKEN) and hmac.compare_digest((token or "").encode(), ADMIN_TOKEN.encode())
+
+
+
+# Isolated Worker Processes
+
+class DocumentProcessingError(Exception):
+    """A document could not be processed; the message is the short reason shown to the user."""
+
+
+
+pdf_worker_ctx = None
+idle_pdf_workers: List[PdfWorker] = []
+pdf_worker_count = 0  # Started workers, busy or idle
+pdf_workers_available = asyncio.Condition()
+
+
+def start_pdf_worker() -> PdfWorker:
+    """Start one worker process (blocking; call from a thread)."""
+    global pdf_worker_ctx
+    if pdf_worker_ctx is None:
+        # forkserver: workers start from a clean process rather than a copy of the threaded server,
+        # with only PyMuPDF and the processing code preloaded, not the web app
+        pdf_worker_ctx = multiprocessing.get_context("forkserver")
+        pdf_worker_ctx.set_forkserver_preload([pdf_worker.__name__])
+    return PdfWorker(pdf_worker_ctx, FILE_CPU_LIMIT, FILE_MEMORY_LIMIT_MB)
+
+
+async def acquire_pdf_worker() -> PdfWorker:
+    """Take an idle worker, starting a new one while fewer than PDF_WORKERS are running."""
+    global pdf_worker_count
+    async with pdf_workers_available:
+        while not idle_pdf_workers and pdf_worker_count >= PDF_WORKERS:
+            await pdf_workers_available.wait()
+        if idle_pdf_workers:
+            return idle_pdf_workers.pop()
+        pdf_worker_count += 1
+    try:
+        worker = await asyncio.to_thread(start_pdf_worker)
+    except Exception:
+        async with pdf_workers_available:
+            pdf_worker_count -= 1
+            pdf_workers_available.notify()
+        raise
+    logger.info(f"Started PDF worker {worker.pid} ({pdf_worker_count}/{PDF_WORKERS})")
+    return worker
+
+
+async def release_pdf_worker(worker: PdfWorker):
+    """Put a worker back in the pool, replacing it first if it died.
+
+    If the replacement cannot be started (e.g. fork fails when memory is
+    short), its slot is freed so a later acquire_pdf_worker starts one.
+    """
+    global pdf_worker_count
+    if not worker.is_alive():
+        await asyncio.to_thread(worker.kill)
+        try:
+            worker = await asyncio.to_thread(start_pdf_worker)
+        except Exception as e:
+            logger.error(f"Could not respawn PDF worker: {e}")
+            async with pdf_workers_available:
+                pdf_worker_count -= 1
+                pdf_workers_available.notify()
+            return
+        watchdog_stats["worker_respawns"] += 1
+    async with pdf_workers_available:
+        idle_pdf_workers.append(worker)
+        pdf_workers_available.notify()
+
+
+async def stop_pdf_workers():
+    """Stop the idle workers; busy ones are stopped with the process."""
+    global pdf_worker_count
+    async with pdf_workers_available:
+        workers = list(idle_pdf_workers)
+        idle_pdf_workers.clear()
+        pdf_worker_count -= len(workers)
+    await asyncio.to_thread(lambda: [worker.stop() for worker in workers])
+
+
+async def run_in_pdf_worker(task: dict) -> tuple:
+    """Run one task in a worker process under the per-document budgets.
+
+    Returns the worker's (status, payload, profile) and counts budget kills;
+    killed workers are replaced.
+    """
+    worker = await acquire_pdf_worker()
+    try:
+        if not worker.is_alive():
+            await release_pdf_worker(worker)
+            worker = await acquire_pdf_worker()
+        status, payload, profile_part = await asyncio.to_thread(worker.run, task, FILE_WALL_TIMEOUT)
+    finally:
+        await release_pdf_worker(worker)
+
+    counter = {
+        "cpu": "cpu_limit_kills",
+        "memory": "memory_limit_kills",
+        "timeout": "timeout_kills",
+        "crash": "worker_crashes",
+    }.get(status)
+    if counter:
+        watchdog_stats[counter] += 1
+        logger.warning(f"Watchdog: {task['filename']}: {payload}")
+    return status, payload, profile_part
+
+
+async def process_pdf_isolated(filename: str, file_bytes: bytes, user_profile: dict, pages: Optional[str] = None,
+                               cache_key: Optional[str] = None, job_profile: Optional[dict] = None) -> bytes:
+    """Run process_single_pdf in a worker process under the per-document budgets.
+
+    Raises DocumentProcessingError with the reason when the document fails or
+    its worker has to be killed.
+    """
+    status, payload, profile_part = await run_in_pdf_worker({
+        "filename": filename,
+        "file_bytes": file_bytes,
+        "user_profile": user_profile,
+        "pages": pages,
+        "cache_key": cache_key,
+        "profile": job_profile is not None,
+    })
+    if job_profile is not None and profile_part is not None:
+        merge_job_profile(job_profile, profile_part)  # Failed files are recorded too, with their reason
+    if status == "ok":
+        return payload
+    raise DocumentProcessingError(payload)
+
+
 # Queue System Functions
 
-async def process_job(job_id: str, files_data: List[tuple], user_profile: dict):
+def touch_job(job_id: str):
+    """Record that a client is still interested in this job"""
+    if job_id in jobs:
+        jobs[job_id]["last_seen"] = datetime.now()
+
+
+def cancel_job(job_id: str, reason: str) -> bool:
+    """Cancel a queued or running job and drop its uploaded files.
+
+    Queued jobs are skipped by the queue worker; running jobs stop before
+    their next file and release their slot.
+    """
+    job_data = jobs.get(job_id)
+    if not job_data or job_data["status"] not in ["queued", "processing"]:
+        return False
+
+    job_data["status"] = "cancelled"
+    job_data["message"] = reason
+    job_data["completed_at"] = datetime.now()
+    files_data = job_data.pop("files_data", None)
+    if files_data is not None:
+        files_data.clear()  # Shared with the queue entry, so this frees the uploads now
+    logger.info(f"Job {job_id}: Cancelled ({reason})")
+    return True
+
+
+def queued_job_count() -> int:
+    """Number of jobs still waiting for a slot (cancelled entries excluded)"""
+    return sum(1 for job_data in jobs.values() if job_data["status"] == "queued")
+
+
+async def process_job(job_id: str, files_data: List[tuple], user_profile: dict, pages: Optional[str] = None,
+                      output_mode: str = "zip", profile: bool = False):
     """Background worker to process a queued job"""
     global active_jobs, total_files_processed
+    job = None
     
     try:
-        jobs[job_id]["status"] = "processing"
-        jobs[job_id]["message"] = "Processing your files..."
-        jobs[job_id]["progress"] = {"current": 0, "total": len(files_data)}
+        # Keep our own reference: a cancelled job can be deleted (DELETE /api/jobs) while a
+        # file is still in flight, and then stops quietly at the next cancellation check
+        job = jobs.get(job_id)
+        if job is None or job["status"] == "cancelled":
+            return
+        job.pop("files_data", None)
+        job["status"] = "processing"
+        job["message"] = "Processing your files..."
+        job["progress"] = {"current": 0, "total": len(files_data)}
         logger.info(f"Job {job_id}: Started processing")
         
-        zip_buffer = io.BytesIO()
+        processed_files = []  # (filename, processed bytes)
         processed_count = 0
         total_files = len(files_data)
         
-        with zipfile.ZipFile(zip_buffer, "w") as zf:
-            for i, (filename, file_bytes) in enumerate(files_data):
-                try:
-                    # Update progress
-                    jobs[job_id]["progress"] = {"current": i + 1, "total": total_files}
-                    jobs[job_id]["message"] = f"Processing file {i + 1} of {total_files}..."
-                    
-                    processed_content = process_single_pdf(file_bytes, user_profile)
-                    zf.writestr(f"processed_{filename}", processed_content)
-                    processed_count += 1
-                    total_files_processed += 1
-                    logger.info(f"Job {job_id}: Successfully processed {filename}")
-                except Exception as e:
-                    logger.error(f"Job {job_id}: Error processing {filename}: {e}")
-                    continue
+        job_profile = None
+        if profile:
+            job_profile = new_job_profile()
+            job["profile"] = job_profile
         
-        if processed_count == 0:
-            jobs[job_id]["status"] = "failed"
-            jobs[job_id]["error"] = "No valid PDF files were processed"
+        for i, (filename, file_bytes) in enumerate(list(files_data)):
+            # Stop between files if the job was cancelled meanwhile
+            if job["status"] == "cancelled":
+                break
+            try:
+                # Update progress
+                job["progress"] = {"current": i + 1, "total": total_files}
+                job["message"] = f"Processing file {i + 1} of {total_files}..."
+                
+                processed_content = await process_pdf_isolated(
+                    filename, file_bytes, user_profile, pages, cache_key=job_id, job_profile=job_profile
+                )
+                processed_files.append((filename, processed_content))
+                processed_count += 1
+                total_files_processed += 1
+                logger.info(f"Job {job_id}: Successfully processed {filename}")
+            except Exception as e:
+                logger.error(f"Job {job_id}: Error processing {filename}: {e}")
+                reason = str(e) if isinstance(e, DocumentProcessingError) else PROCESSING_FAILED
+                job.setdefault("failed_files", []).append({"filename": filename, "reason": reason})
+                continue
+            finally:
+                # Yield so status polls and cancellations are served between files
+                await asyncio.sleep(0)
+        
+        if job["status"] == "cancelled":
+            logger.info(f"Job {job_id}: Stopped after cancellation ({processed_count} files done)")
+        elif processed_count == 0:
+            job["status"] = "failed"
+            job["error"] = "No valid PDF files were processed"
             logger.error(f"Job {job_id}: Failed - no files processed")
         else:
-            zip_buffer.seek(0)
-            jobs[job_id]["status"] = "completed"
-            jobs[job_id]["result"] = zip_buffer.getvalue()
-            jobs[job_id]["completed_at"] = datetime.now()
+            result_bytes, media_type, result_filename = await asyncio.to_thread(build_output, processed_files, output_mode)
+            job["status"] = "completed"
+            job["result"] = result_bytes
+            job["result_media_type"] = media_type
+            job["result_filename"] = result_filename
+            job["completed_at"] = datetime.now()
             logger.info(f"Job {job_id}: Completed successfully ({processed_count} files)")
             
     except Exception as e:
-        jobs[job_id]["status"] = "failed"
-        jobs[job_id]["error"] = str(e)
+        if job is not None and job["status"] != "cancelled":
+            job["status"] = "failed"
+            job["error"] = str(e)
         logger.error(f"Job {job_id}: Failed with error: {e}")
     finally:
         async with processing_lock:
             active_jobs -= 1
         logger.info(f"Active jobs: {active_jobs}")
 
+
 # ... (queue_worker and cleanup_old_jobs remain same) ...
 
 # API Endpoints
@@ -127,322 +382,10 @@ async def get_stats():
     return {
         "total_processed": total_files_processed,
         "active_jobs": active_jobs,
-        "queued_jobs": job_queue.qsize()
+        "queued_jobs": queued_job_count(),
+        "watchdog": watchdog_stats
     }
 
-def map_font(font_name, font_flags):
-    """Map PDF font names to standard PyMuPDF font codes."""
-    name_lower = font_name.lower()
-    is_bold = (font_flags & 2**4) or "bold" in name_lower
-    
-    if "times" in name_lower or "serif" in name_lower:
-        return "tibo" if is_bold else "tiro"
-    elif "courier" in name_lower or "mono" in name_lower:
-        return "cobo" if is_bold else "cour"
-    else:
-        return "hebo" if is_bold else "helv"
-
-def smart_parse_inputs(user_profile):
-    """Pre-process user inputs to infer missing details."""
-    refined = user_profile.copy()
-    if not refined.get('div') and refined.get('class'):
-        match = re.search(r"(?i)(Div|Section|Group|Batch)\s*[:\-\.]?\s*([A-Z0-9]+)", refined['class'])
-        if match:
-            refined['div'] = match.group(2)
-    return refined
-
-def validate_pdf(file_bytes: bytes) -> bool:
-    """Validate if the file is a valid PDF."""
-    try:
-        doc = fitz.open(stream=file_bytes, filetype="pdf")
-        doc.close()
-        return True
-    except Exception as e:
-        logger.error(f"PDF validation failed: {e}")
-        return False
-
-def process_single_pdf(file_bytes, user_details):
-    """Process a single PDF: find field labels on page 1 using native search, replace their values."""
-    try:
-        doc = fitz.open(stream=file_bytes, filetype="pdf")
-        details = smart_parse_inputs(user_details)
-        logger.info(f"Processing PDF with details: {details}")
-
-        # Labels to search for, ordered most-specific first to avoid partial matches
-        # Each entry: (user_input_key, [label_variants])
-        field_config = [
-            ('name',     ['Student Name', 'Candidate Name', 'Name of Student', 'Name of the Student', 'Name']),
-            ('roll',     ['Roll No.', 'Roll No', 'Roll Number', 'Seat No.', 'Seat No', 'Roll']),
-            ('class',    ['Class', 'Branch', 'Course', 'Year']),
-            ('div',      ['Division', 'Div.', 'Div', 'Section', 'Batch']),
-            ('prn',      ['PRN No.', 'PRN No', 'P.R.N.', 'PRN', 'Registration No', 'Reg No', 'ID No']),
-            ('activity', ['Experiment No.', 'Experiment No', 'Exp No.', 'Exp No', 'Aim', 'Experiment', 'Activity', 'Title']),
-        ]
-
-        replacements_made = 0
-
-        if len(doc) == 0:
-            out_buffer = io.BytesIO()
-            doc.save(out_buffer)
-            doc.close()
-            out_buffer.seek(0)
-            return out_buffer.getvalue()
-
-        page = doc[0]
-        page_width = page.rect.width
-
-        # Get text dict once for font/position lookups
-        text_dict = page.get_text("dict")
-        header_spans = []
-        for block in text_dict["blocks"]:
-            if "lines" not in block or block["bbox"][1] > HEADER_LIMIT_Y:
-                continue
-            for line in block["lines"]:
-                for span in line["spans"]:
-                    header_spans.append(span)
-
-        # Step 1: Find ALL label positions on page 1 for boundary detection
-        all_label_rects = []  # (rect, field_key)
-        for field_key, variants in field_config:
-            for label in variants:
-                for hit in page.search_for(label):
-                    if hit.y0 <= HEADER_LIMIT_Y:
-                        all_label_rects.append((hit, field_key))
-
-        logger.info(f"Found {len(all_label_rects)} label positions in header area")
-        for lr, lk in all_label_rects:
-            logger.info(f"  Label '{lk}' at x={lr.x0:.0f}, y={lr.y0:.0f}")
-
-        # Step 2: For each user-provided field, find FIRST label match and replace its value
-        modifications = []
-        fields_done = set()
-
-        for field_key, label_variants in field_config:
-            if field_key in fields_done:
-                continue
-            user_val = details.get(field_key)
-            if not user_val:
-                continue
-
-            for label_text in label_variants:
-                if field_key in fields_done:
-                    break
-
-                hits = page.search_for(label_text)
-                for hit in hits:
-                    if hit.y0 > HEADER_LIMIT_Y or field_key in fields_done:
-                        continue
-
-                    logger.info(f"  Matched '{label_text}' for field '{field_key}' at y={hit.y0:.0f}")
-
-                    # Find right boundary: next label on same line, or page edge
-                    right_bound = page_width
-                    for other_rect, other_key in all_label_rects:
-                        if other_key == field_key:
-                            continue
-                        # Same horizontal band and to the right of our label
-                        if (abs(other_rect.y0 - hit.y0) < 10 and
-                            other_rect.x0 > hit.x1 + 5):
-                            right_bound = min(right_bound, other_rect.x0 - 2)
-
-                    # Value area: rectangle from end of label to right boundary
-                    val_rect = fitz.Rect(hit.x1, hit.y0 - 1, right_bound, hit.y1 + 1)
-
-                    # Get existing text in value area to detect separator
-                    existing = page.get_text("text", clip=val_rect).strip()
-
-                    # Auto-detect separator (: or - or .)
-                    sep = ": "
-                    if existing:
-                        m = re.match(r'^(\s*[:\-\.]\s*)', existing)
-                        if m:
-                            sep = m.group(1)
-                            if not sep.endswith(' '):
-                                sep += ' '
-
-                    # Find font info from nearest span in the value area
-                    font_name = "helv"
-                    font_size = 12
-                    font_color = 0
-                    font_flags = 0
-                    baseline_y = hit.y1 - (hit.y1 - hit.y0) * 0.2
-
-                    for sp in header_spans:
-                        sp_rect = fitz.Rect(sp["bbox"])
-                        if sp_rect.intersects(val_rect):
-                            font_name = sp["font"]
-                            font_size = sp["size"]
-                            font_color = sp["color"]
-                            font_flags = sp["flags"]
-                            baseline_y = sp["origin"][1]
-                            break
-
-                    # Fallback: use the label's own font if nothing found in value area
-                    if font_name == "helv":
-                        for sp in header_spans:
-                            sp_rect = fitz.Rect(sp["bbox"])
-                            if sp_rect.intersects(fitz.Rect(hit)):
-                                font_name = sp["font"]
-                                font_size = sp["size"]
-                                font_color = sp["color"]
-                                font_flags = sp["flags"]
-                                baseline_y = sp["origin"][1]
-                                break
-
-                    modifications.append({
-                        'redact_rect': val_rect,
-                        'label_rect': hit,
-                        'label_text': label_text,
-                        'insert_x': hit.x1,
-                        'insert_y': baseline_y,
-                        'font': font_name,
-                        'size': font_size,
-                        'color': font_color,
-                        'flags': font_flags,
-                        'sep': sep,
-                        'user_val': user_val,
-                        'text': sep + user_val,
-                        'field_key': field_key,
-                    })
-
-                    logger.info(f"  >> Will replace {field_key}: '{existing}' -> '{sep}{user_val}'")
-                    fields_done.add(field_key)
-                    replacements_made += 1
-                    break  # First hit only for this label variant
-
-        # Step 3: Group by line, redact, then insert with equal spacing for multi-field lines
-        if modifications:
-            from collections import defaultdict
-            
-            # Group modifications by Y position (8pt tolerance for same line)
-            line_groups = defaultdict(list)
-            for mod in modifications:
-                y_key = round(mod['label_rect'].y0 / 8) * 8
-                line_groups[y_key].append(mod)
-            
-            # Phase 1: Add all redaction annotations
-            for y_key, group in line_groups.items():
-                group.sort(key=lambda m: m['label_rect'].x0)
-                
-                if len(group) == 1:
-                    # Single field: redact just the value area
-                    page.add_redact_annot(group[0]['redact_rect'], fill=(1, 1, 1))
-                else:
-                    # Multiple fields on same line: redact entire line area (labels + values)
-                    line_x0 = min(m['label_rect'].x0 for m in group)
-                    line_x1 = max(m['redact_rect'].x1 for m in group)
-                    line_y0 = min(m['label_rect'].y0 for m in group) - 1
-                    line_y1 = max(m['label_rect'].y1 for m in group) + 1
-                    full_line_rect = fitz.Rect(line_x0, line_y0, line_x1, line_y1)
-                    page.add_redact_annot(full_line_rect, fill=(1, 1, 1))
-            
-            page.apply_redactions()
-            
-            # Phase 2: Insert text
-            for y_key, group in sorted(line_groups.items()):
-                group.sort(key=lambda m: m['label_rect'].x0)
-                
-                # Get font info from first field in the group
-                mod0 = group[0]
-                mapped_font = map_font(mod0['font'], mod0['flags'])
-                font_size = mod0['size']
-                c = mod0['color']
-                r_c = ((c >> 16) & 255) / 255
-                g_c = ((c >> 8) & 255) / 255
-                b_c = (c & 255) / 255
-                baseline_y = mod0['insert_y']
-                
-                if len(group) == 1:
-                    # Single field: insert at original position
-                    mod = group[0]
-                    try:
-                        page.insert_text(
-                            (mod['insert_x'], mod['insert_y']),
-                            mod['text'],
-                            fontname=mapped_font,
-                            fontsize=font_size,
-                            color=(r_c, g_c, b_c)
-                        )
-                        logger.info(f"  Inserted '{mod['text'].strip()}' for {mod['field_key']}")
-                    except Exception as e:
-                        page.insert_text(
-                            (mod['insert_x'], mod['insert_y']),
-                            mod['text'],
-                            fontname="helv",
-                            fontsize=font_size,
-                            color=(r_c, g_c, b_c)
-                        )
-                else:
-                    # Multiple fields: lay out with equal spacing
-                    # Build text segments: "Label: Value"
-                    segments = []
-                    for mod in group:
-                        seg_text = mod['label_text'] + mod['sep'] + mod['user_val']
-                        try:
-                            seg_width = fitz.get_text_length(seg_text, fontname=mapped_font, fontsize=font_size)
-                        except:
-                            seg_width = fitz.get_text_length(seg_text, fontname="helv", fontsize=font_size)
-                            mapped_font = "helv"
-                        segments.append((seg_text, seg_width, mod))
-                    
-                    # Calculate equal gap spacing — capped to page margins
-                    right_margin = page_width - 36  # 36pt = ~0.5 inch margin
-                    line_x0 = min(m['label_rect'].x0 for m in group)
-                    line_x1 = min(max(m['redact_rect'].x1 for m in group), right_margin)
-                    total_line_width = line_x1 - line_x0
-                    total_text_width = sum(w for _, w, _ in segments)
-                    
-                    if len(segments) > 1 and total_line_width > total_text_width:
-                        gap = (total_line_width - total_text_width) / (len(segments) - 1)
-                    else:
-                        gap = font_size * 2
-                    
-                    gap = max(gap, font_size * 0.5)  # minimum half-em gap
-                    
-                    # If everything would overflow the margin, shrink gap to fit
-                    total_needed = total_text_width + gap * (len(segments) - 1)
-                    if line_x0 + total_needed > right_margin and len(segments) > 1:
-                        available = right_margin - line_x0 - total_text_width
-                        gap = max(available / (len(segments) - 1), font_size * 0.3)
-                    
-                    # Insert each segment at calculated position
-                    current_x = line_x0
-                    for seg_text, seg_width, mod in segments:
-                        try:
-                            page.insert_text(
-                                (current_x, baseline_y),
-                                seg_text,
-                                fontname=mapped_font,
-                                fontsize=font_size,
-                                color=(r_c, g_c, b_c)
-                            )
-                        except:
-                            page.insert_text(
-                                (current_x, baseline_y),
-                                seg_text,
-                                fontname="helv",
-                                fontsize=font_size,
-                                color=(r_c, g_c, b_c)
-                            )
-                        logger.info(f"  Inserted '{seg_text}' at x={current_x:.0f}")
-                        current_x += seg_width + gap
-
-        logger.info(f"Total replacements made: {replacements_made}")
-        if replacements_made == 0:
-            logger.warning("NO REPLACEMENTS MADE - no matching field labels found on page 1")
-
-        out_buffer = io.BytesIO()
-        doc.save(out_buffer, garbage=4, deflate=True, clean=True)
-        doc.close()
-        out_buffer.seek(0)
-        pdf_bytes = out_buffer.getvalue()
-        logger.info(f"Returning PDF with {len(pdf_bytes)} bytes")
-        return pdf_bytes
-    except Exception as e:
-        logger.error(f"Error processing PDF: {e}")
-        import traceback
-        traceback.print_exc()
-        raise
 
 
 
@@ -458,6 +401,10 @@ async def queue_worker():
             job_data = await job_queue.get()
             job_id = job_data["job_id"]
             
+            # Cancelled while waiting - drop it without taking a slot
+            if job_id not in jobs or jobs[job_id]["status"] == "cancelled":
+                continue
+            
             # Wait until we have a free slot
             while True:
                 async with processing_lock:
@@ -470,7 +417,10 @@ async def queue_worker():
             asyncio.create_task(process_job(
                 job_id,
                 job_data["files_data"],
-                job_data["user_profile"]
+                job_data["user_profile"],
+                job_data.get("pages"),
+                job_data.get("output", "zip"),
+                job_data.get("profile", False)
             ))
             
         except Exception as e:
@@ -486,7 +436,7 @@ async def cleanup_old_jobs():
             to_delete = []
             
             for job_id, job_data in jobs.items():
-                if job_data["status"] in ["completed", "failed"]:
+                if job_data["status"] in ["completed", "failed", "cancelled"]:
                     created_at = job_data.get("created_at")
                     if created_at and (now - created_at).total_seconds() > JOB_RETENTION_TIME:
                         to_delete.append(job_id)
@@ -499,6 +449,24 @@ async def cleanup_old_jobs():
             logger.error(f"Cleanup error: {e}")
 
 
+async def cancel_abandoned_jobs():
+    """Periodically cancel jobs whose client stopped polling (e.g. closed the tab)"""
+    while True:
+        try:
+            await asyncio.sleep(JOB_IDLE_CHECK_INTERVAL)
+            now = datetime.now()
+            
+            for job_id, job_data in list(jobs.items()):
+                if job_data["status"] not in ["queued", "processing"]:
+                    continue
+                last_seen = job_data.get("last_seen") or job_data.get("created_at")
+                if last_seen and (now - last_seen).total_seconds() > JOB_IDLE_TIMEOUT:
+                    cancel_job(job_id, "Cancelled: client stopped checking on this job")
+                    
+        except Exception as e:
+            logger.error(f"Abandoned job check error: {e}")
+
+
 # Events handle by lifespan above
 
 
@@ -512,7 +480,7 @@ async def health_check():
         "status": "healthy",
         "service": "PDF Personalizer",
         "active_jobs": active_jobs,
-        "queued_jobs": job_queue.qsize()
+        "queued_jobs": queued_job_count()
     }
 
 
@@ -524,10 +492,20 @@ async def queue_job(
     classname: Optional[str] = Form(None),
     div: Optional[str] = Form(None),
     prn: Optional[str] = Form(None),
-    activity: Optional[str] = Form(None)
+    activity: Optional[str] = Form(None),
+    pages: Optional[str] = Form(None),
+    output: Optional[str] = Form("zip"),
+    profile: bool = Form(False),
+    x_admin_token: Optional[str] = Header(None)
 ):
     """Submit a job to the processing queue"""
     try:
+        # Profiling is admin-only; otherwise a PROFILE_SAMPLE_RATE fraction of jobs is sampled
+        if profile and not is_admin(x_admin_token):
+            raise HTTPException(status_code=403, detail="Profiling requires an admin token")
+        if not profile and PROFILE_SAMPLE_RATE > 0:
+            profile = random.random() < PROFILE_SAMPLE_RATE
+        
         # Validate number of files
         if len(files) > MAX_FILES:
             raise HTTPException(status_code=400, detail=f"Maximum {MAX_FILES} files allowed")
@@ -548,6 +526,16 @@ async def queue_job(
         if not any(user_profile.values()):
             raise HTTPException(status_code=400, detail="Please provide at least one detail to personalize")
         
+        # Validate page selection ("all", or ranges like "1-3,5"); default is page 1 only
+        try:
+            parse_page_selection(pages, 0)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        
+        output = output or "zip"
+        if output not in OUTPUT_MODES:
+            raise HTTPException(status_code=400, detail=f"Output must be one of: {', '.join(OUTPUT_MODES)}")
+        
         # Read and validate files
         files_data = []
         for file in files:
@@ -559,7 +547,9 @@ async def queue_job(
             if len(content) > MAX_FILE_SIZE:
                 continue
             
-            if not validate_pdf(content):
+            # Header check only: opening the file is left to the budgeted worker, which
+            # records unreadable files in failed_files
+            if not has_pdf_header(content):
                 continue
             
             files_data.append((file.filename, content))
@@ -569,12 +559,14 @@ async def queue_job(
         
         # Create job
         job_id = str(uuid.uuid4())
-        queue_position = job_queue.qsize() + 1
+        queue_position = queued_job_count() + 1
         
         jobs[job_id] = {
             "status": "queued",
             "position": queue_position,
             "created_at": datetime.now(),
+            "last_seen": datetime.now(),
+            "files_data": files_data,
             "message": f"Position in queue: #{queue_position}"
         }
         
@@ -582,10 +574,13 @@ async def queue_job(
         await job_queue.put({
             "job_id": job_id,
             "files_data": files_data,
-            "user_profile": user_profile
+            "user_profile": user_profile,
+            "pages": pages,
+            "output": output,
+            "profile": profile
         })
         
-        logger.info(f"Job {job_id}: Added to queue (position {queue_position})")
+        logger.info(f"Job {job_id}: Added to queue (position {queue_position}){' with profiling' if profile else ''}")
         
         return {
             "job_id": job_id,
@@ -607,6 +602,7 @@ async def get_job_status(job_id: str):
     if job_id not in jobs:
         raise HTTPException(status_code=404, detail="Job not found")
     
+    touch_job(job_id)
     job_data = jobs[job_id]
     status = job_data["status"]
     
@@ -634,10 +630,18 @@ async def get_job_status(job_id: str):
     elif status == "completed":
         response["message"] = "Processing complete!"
         response["download_url"] = f"/api/download/{job_id}"
+        response["filename"] = job_data.get("result_filename", "processed_lab_reports.zip")
         
     elif status == "failed":
         response["error"] = job_data.get("error", "Unknown error")
         response["message"] = "Processing failed"
+        
+    elif status == "cancelled":
+        response["message"] = job_data.get("message", "Job cancelled")
+    
+    # Files skipped within an otherwise finished job
+    if status in ["completed", "failed"] and job_data.get("failed_files"):
+        response["failed_files"] = job_data["failed_files"]
     
     return response
 
@@ -648,6 +652,7 @@ async def download_result(job_id: str):
     if job_id not in jobs:
         raise HTTPException(status_code=404, detail="Job not found")
     
+    touch_job(job_id)
     job_data = jobs[job_id]
     
     if job_data["status"] != "completed":
@@ -657,17 +662,71 @@ async def download_result(job_id: str):
         raise HTTPException(status_code=404, detail="Result not found")
     
     result_bytes = job_data["result"]
+    result_filename = job_data.get("result_filename", "processed_lab_reports.zip")
     
     return StreamingResponse(
         io.BytesIO(result_bytes),
-        media_type="application/zip",
+        media_type=job_data.get("result_media_type", "application/zip"),
         headers={
-            "Content-Disposition": "attachment; filename=processed_lab_reports.zip",
+            "Content-Disposition": f"attachment; filename={result_filename}",
             "Content-Length": str(len(result_bytes))
         }
     )
 
 
+@app.delete("/api/jobs/{job_id}")
+async def delete_job(job_id: str):
+    """Cancel a queued/running job, or discard a finished job's result"""
+    if job_id not in jobs:
+        raise HTTPException(status_code=404, detail="Job not found")
+    
+    if cancel_job(job_id, "Cancelled by user"):
+        return {"job_id": job_id, "status": "cancelled"}
+    
+    # Already finished - free the stored result right away
+    del jobs[job_id]
+    logger.info(f"Job {job_id}: Deleted by user")
+    return {"job_id": job_id, "status": "deleted"}
+
+
+@app.get("/api/admin/jobs/{job_id}/profile")
+async def get_job_profile(job_id: str, format: str = "json", x_admin_token: Optional[str] = Header(None)):
+    """Get the profile captured for a job: json summary, collapsed stacks or speedscope JSON"""
+    if not is_admin(x_admin_token):
+        raise HTTPException(status_code=403, detail="Admin token required")
+    
+    if job_id not in jobs:
+        raise HTTPException(status_code=404, detail="Job not found")
+    
+    job_profile = jobs[job_id].get("profile")
+    if job_profile is None:
+        raise HTTPException(status_code=404, detail="No profile recorded for this job")
+    
+    if format == "collapsed":
+        # Weights in microseconds of measured time, so flame graph widths match stage_timings
+        lines = [f"{stack} {round(seconds * 1e6)}" for stack, seconds in job_profile["stack_seconds"].most_common()]
+        return PlainTextResponse("\n".join(lines) + "\n")
+    
+    if format == "speedscope":
+        return JSONResponse(
+            profile_to_speedscope(job_id, job_profile),
+            headers={"Content-Disposition": f"attachment; filename=profile_{job_id}.speedscope.json"}
+        )
+    
+    if format != "json":
+        raise HTTPException(status_code=400, detail="Format must be one of: json, collapsed, speedscope")
+    
+    return {
+        "job_id": job_id,
+        "status": jobs[job_id]["status"],
+        "sample_interval": job_profile["interval"],
+        "samples": sum(job_profile["stacks"].values()),
+        "sampled_seconds": round(sum(job_profile["stack_seconds"].values()), 6),
+        "stage_timings": {stage: round(t, 6) for stage, t in job_profile["stage_timings"].items()},
+        "files": job_profile["files"],
+    }
+
+
 # Keep original endpoint for backward compatibility
 
 
@@ -686,7 +745,9 @@ async def process_files(
     classname: Optional[str] = Form(None),
     div: Optional[str] = Form(None),
     prn: Optional[str] = Form(None),
-    activity: Optional[str] = Form(None)
+    activity: Optional[str] = Form(None),
+    pages: Optional[str] = Form(None),
+    output: Optional[str] = Form("zip")
 ):
     """Process uploaded PDF files with user details."""
     try:
@@ -710,49 +771,59 @@ async def process_files(
         if not any(user_profile.values()):
             raise HTTPException(status_code=400, detail="Please provide at least one detail to personalize")
         
-        zip_buffer = io.BytesIO()
+        # Validate page selection ("all", or ranges like "1-3,5"); default is page 1 only
+        try:
+            parse_page_selection(pages, 0)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        
+        output = output or "zip"
+        if output not in OUTPUT_MODES:
+            raise HTTPException(status_code=400, detail=f"Output must be one of: {', '.join(OUTPUT_MODES)}")
+        
+        processed_files = []
         processed_count = 0
+        cache_key = str(uuid.uuid4())  # Lets workers reuse header plans across this request's files
         
-        with zipfile.ZipFile(zip_buffer, "w") as zf:
-            for file in files:
-                # Validate file type
-                if not file.filename.lower().endswith('.pdf'):
-                    logger.warning(f"Skipping non-PDF file: {file.filename}")
-                    continue
-                
-                content = await file.read()
-                
-                # Validate file size
-                if len(content) > MAX_FILE_SIZE:
-                    logger.warning(f"File too large: {file.filename}")
-                    continue
-                
-                # Validate PDF format
-                if not validate_pdf(content):
-                    logger.warning(f"Invalid PDF: {file.filename}")
-                    continue
-                
-                try:
-                    processed_content = process_single_pdf(content, user_profile)
-                    zf.writestr(f"processed_{file.filename}", processed_content)
-                    processed_count += 1
-                    logger.info(f"Successfully processed: {file.filename}")
-                except Exception as e:
-                    logger.error(f"Error processing {file.filename}: {e}")
-                    continue
+        for file in files:
+            # Validate file type
+            if not file.filename.lower().endswith('.pdf'):
+                logger.warning(f"Skipping non-PDF file: {file.filename}")
+                continue
+            
+            content = await file.read()
+            
+            # Validate file size
+            if len(content) > MAX_FILE_SIZE:
+                logger.warning(f"File too large: {file.filename}")
+                continue
+            
+            # Validate PDF format (unreadable files are rejected by the worker)
+            if not has_pdf_header(content):
+                logger.warning(f"Invalid PDF: {file.filename}")
+                continue
+            
+            try:
+                processed_content = await process_pdf_isolated(file.filename, content, user_profile, pages, cache_key)
+                processed_files.append((file.filename, processed_content))
+                processed_count += 1
+                logger.info(f"Successfully processed: {file.filename}")
+            except Exception as e:
+                logger.error(f"Error processing {file.filename}: {e}")
+                continue
         
         if processed_count == 0:
             raise HTTPException(status_code=400, detail="No valid PDF files were processed")
         
-        zip_buffer.seek(0)
+        result_bytes, media_type, result_filename = await asyncio.to_thread(build_output, processed_files, output)
         logger.info(f"Successfully processed {processed_count} files")
         
         return StreamingResponse(
-            zip_buffer,
-            media_type="application/zip",
+            io.BytesIO(result_bytes),
+            media_type=media_type,
             headers={
-                "Content-Disposition": "attachment; filename=processed_lab_reports.zip",
-                "Content-Length": str(zip_buffer.getbuffer().nbytes)
+                "Content-Disposition": f"attachment; filename={result_filename}",
+                "Content-Length": str(len(result_bytes))
             }
         )
     except HTTPException:
@@ -0,0 +1,557 @@
+"""PDF personalization: header detection, planning, redaction and output packaging.
+
+Kept free of the web framework so PDF worker processes only load PyMuPDF and this module.
+"""
+from typing import List, Optional
+from contextlib import contextmanager
+from collections import Counter
+import fitz  # PyMuPDF
+import re
+import io
+import zipfile
+import os
+import sys
+import time
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Constants
+HEADER_LIMIT_Y = 500  # Covers typical lab report headers including logos, tables, field rows
+HEADER_FINGERPRINT_MARGIN = 50  # Extra height read when fingerprinting headers, so labels near the limit are included
+HEADER_TEXT_FLAGS = fitz.TEXTFLAGS_DICT & ~fitz.TEXT_PRESERVE_IMAGES  # Text spans only - image bytes are never used
+
+# Labels to search for, ordered most-specific first to avoid partial matches
+# Each entry: (user_input_key, [label_variants])
+FIELD_CONFIG = [
+    ('name',     ['Student Name', 'Candidate Name', 'Name of Student', 'Name of the Student', 'Name']),
+    ('roll',     ['Roll No.', 'Roll No', 'Roll Number', 'Seat No.', 'Seat No', 'Roll']),
+    ('class',    ['Class', 'Branch', 'Course', 'Year']),
+    ('div',      ['Division', 'Div.', 'Div', 'Section', 'Batch']),
+    ('prn',      ['PRN No.', 'PRN No', 'P.R.N.', 'PRN', 'Registration No', 'Reg No', 'ID No']),
+    ('activity', ['Experiment No.', 'Experiment No', 'Exp No.', 'Exp No', 'Aim', 'Experiment', 'Activity', 'Title']),
+]
+LABEL_VARIANTS_LOWER = [label.lower() for _, variants in FIELD_CONFIG for label in variants]
+# Processed PDFs are already deflated, so the ZIP only stores them unless ZIP_DEFLATE=1
+ZIP_COMPRESSION = zipfile.ZIP_DEFLATED if os.environ.get("ZIP_DEFLATE") == "1" else zipfile.ZIP_STORED
+PROFILE_INTERVAL = 0.005  # Seconds between stack samples while profiling
+
+# Profiling
+
+class StackSampler:
+    """Samples one thread's Python stack about every `interval` seconds and counts collapsed stacks.
+
+    The sampler can only run when the sampled thread releases the GIL, which
+    PyMuPDF holds for the duration of its calls. Each sample therefore also
+    adds the measured time since the previous sample to `seconds`, so a long
+    MuPDF call is charged (to the stack seen right after it) at its real length
+    instead of one interval.
+
+    Stacks are rooted at `root_function` when it is on the stack, so server and
+    event-loop frames above it are left out.
+    """
+
+    def __init__(self, thread_id: int, counts: Counter, seconds: Counter, interval: float = PROFILE_INTERVAL,
+                 root_function: str = "process_single_pdf"):
+        self.thread_id = thread_id
+        self.counts = counts
+        self.seconds = seconds
+        self.interval = interval
+        self.root_function = root_function
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="stack-sampler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+
+    def _run(self):
+        last = time.perf_counter()
+        while not self._stop.wait(self.interval):
+            now = time.perf_counter()
+            elapsed, last = now - last, now
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                if code.co_name == self.root_function:
+                    break
+                frame = frame.f_back
+            if stack:
+                key = ";".join(reversed(stack))
+                self.counts[key] += 1
+                self.seconds[key] += elapsed
+
+
+@contextmanager
+def stage_timer(timings: Optional[dict], stage: str):
+    """Add the time spent in the block to timings[stage]; does nothing when timings is None."""
+    if timings is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[stage] = timings.get(stage, 0.0) + time.perf_counter() - started
+
+
+def new_job_profile() -> dict:
+    # stacks: samples per collapsed stack; stack_seconds: measured time those samples stand for
+    return {"interval": PROFILE_INTERVAL, "stacks": Counter(), "stack_seconds": Counter(), "stage_timings": {}, "files": []}
+
+
+def merge_job_profile(job_profile: dict, part: dict):
+    """Fold a profile captured in a worker process into the job's profile."""
+    job_profile["stacks"].update(part["stacks"])
+    job_profile["stack_seconds"].update(part["stack_seconds"])
+    job_profile["files"].extend(part["files"])
+    for stage, t in part["stage_timings"].items():
+        job_profile["stage_timings"][stage] = job_profile["stage_timings"].get(stage, 0.0) + t
+
+
+def profile_single_pdf(job_profile: dict, filename: str, file_bytes, user_profile: dict,
+                       pages: Optional[str], plan_cache: dict):
+    """Run process_single_pdf under the stack sampler and record its stage timings."""
+    stage_timings = {}
+    sampler = StackSampler(threading.get_ident(), job_profile["stacks"], job_profile["stack_seconds"],
+                           job_profile["interval"])
+    started = time.perf_counter()
+    sampler.start()
+    try:
+        return process_single_pdf(file_bytes, user_profile, pages, plan_cache, stage_timings)
+    finally:
+        sampler.stop()
+        job_profile["files"].append({
+            "filename": filename,
+            "seconds": round(time.perf_counter() - started, 6),
+            "stage_timings": {stage: round(t, 6) for stage, t in stage_timings.items()},
+        })
+        for stage, t in stage_timings.items():
+            job_profile["stage_timings"][stage] = job_profile["stage_timings"].get(stage, 0.0) + t
+
+
+def map_font(font_name, font_flags):
+    """Map PDF font names to standard PyMuPDF font codes."""
+    name_lower = font_name.lower()
+    is_bold = (font_flags & 2**4) or "bold" in name_lower
+    
+    if "times" in name_lower or "serif" in name_lower:
+        return "tibo" if is_bold else "tiro"
+    elif "courier" in name_lower or "mono" in name_lower:
+        return "cobo" if is_bold else "cour"
+    else:
+        return "hebo" if is_bold else "helv"
+
+def smart_parse_inputs(user_profile):
+    """Pre-process user inputs to infer missing details."""
+    refined = user_profile.copy()
+    if not refined.get('div') and refined.get('class'):
+        match = re.search(r"(?i)(Div|Section|Group|Batch)\s*[:\-\.]?\s*([A-Z0-9]+)", refined['class'])
+        if match:
+            refined['div'] = match.group(2)
+    return refined
+
+def build_output(processed_files: List[tuple], output_mode: str = "zip") -> tuple:
+    """Package processed PDFs as a ZIP of separate files or as one merged PDF.
+
+    Returns (result_bytes, media_type, download_filename).
+    """
+    out_buffer = io.BytesIO()
+
+    if output_mode == "merged":
+        merged = fitz.open()
+        for filename, pdf_bytes in processed_files:
+            src = fitz.open(stream=pdf_bytes, filetype="pdf")
+            merged.insert_pdf(src)
+            src.close()
+        # garbage=4 also merges identical objects, so fonts and images shared by
+        # documents from the same template are stored only once
+        merged.save(out_buffer, garbage=4, deflate=True, clean=True)
+        merged.close()
+        return out_buffer.getvalue(), "application/pdf", "processed_lab_reports.pdf"
+
+    with zipfile.ZipFile(out_buffer, "w", compression=ZIP_COMPRESSION) as zf:
+        for filename, pdf_bytes in processed_files:
+            zf.writestr(f"processed_{filename}", pdf_bytes)
+    return out_buffer.getvalue(), "application/zip", "processed_lab_reports.zip"
+
+def has_pdf_header(file_bytes: bytes) -> bool:
+    """Cheap upload check: a PDF starts with "%PDF-" within its first 1024 bytes.
+
+    Files that pass but cannot be opened are rejected by the worker that processes them.
+    """
+    return b"%PDF-" in file_bytes[:1024]
+
+
+def validate_pdf(file_bytes: bytes) -> bool:
+    """Validate if the file is a valid PDF."""
+    try:
+        doc = fitz.open(stream=file_bytes, filetype="pdf")
+        doc.close()
+        return True
+    except Exception as e:
+        logger.error(f"PDF validation failed: {e}")
+        return False
+
+def parse_page_selection(spec: Optional[str], page_count: int) -> List[int]:
+    """Turn a page spec into 0-based page numbers.
+
+    None/"" means the first page only, "all" means every page, otherwise a
+    comma-separated list of 1-based pages and ranges such as "1-3,5".
+    Pages past the end of the document are ignored.
+    """
+    if not spec:
+        return [0] if page_count else []
+    spec = spec.strip().lower()
+    if spec == "all":
+        return list(range(page_count))
+
+    selected = set()
+    for part in spec.split(","):
+        part = part.strip()
+        match = re.fullmatch(r"(\d+)(?:\s*-\s*(\d+))?", part)
+        if not match:
+            raise ValueError(f"Invalid page selection: '{part}'")
+        start = int(match.group(1))
+        end = int(match.group(2)) if match.group(2) else start
+        if start < 1 or end < start:
+            raise ValueError(f"Invalid page range: '{part}'")
+        selected.update(p - 1 for p in range(start, min(end, page_count) + 1))
+    return sorted(selected)
+
+
+def header_fingerprint(page) -> tuple:
+    """Cheap identity of a page's header: page geometry plus the text rows holding field labels.
+
+    Only rows that contain a label (or share a band with one) can change the
+    label/boundary/font plan, so body text in the header area does not break reuse.
+    Pages with the same fingerprint get the same plan.
+    """
+    clip = fitz.Rect(0, 0, page.rect.width, HEADER_LIMIT_Y + HEADER_FINGERPRINT_MARGIN)
+    lines = [line for block in page.get_text("dict", clip=clip, flags=HEADER_TEXT_FLAGS)["blocks"] for line in block.get("lines", [])]
+
+    label_bands = []
+    for line in lines:
+        line_text = "".join(span["text"] for span in line["spans"]).lower()
+        if any(label in line_text for label in LABEL_VARIANTS_LOWER):
+            label_bands.append((line["bbox"][1] - 10, line["bbox"][3] + 10))
+
+    spans = []
+    for line in lines:
+        y0, y1 = line["bbox"][1], line["bbox"][3]
+        if not any(y0 < band_y1 and y1 > band_y0 for band_y0, band_y1 in label_bands):
+            continue
+        for span in line["spans"]:
+            spans.append((
+                span["text"], span["font"], round(span["size"], 2), span["color"],
+                tuple(round(v, 1) for v in span["bbox"]),
+            ))
+    return (round(page.rect.width, 1), round(page.rect.height, 1), page.rotation, tuple(spans))
+
+
+def plan_header(page, details):
+    """Find field labels in the page header and work out what to redact and insert.
+
+    Returns {'redactions': [Rect, ...], 'inserts': [(point, text, font, size, color), ...],
+    'replacements': int}. The plan only depends on the header layout, so it can be
+    applied to any page with the same header fingerprint.
+    """
+    plan = {'redactions': [], 'inserts': [], 'replacements': 0}
+    page_width = page.rect.width
+
+    # Get text dict once for font/position lookups
+    text_dict = page.get_text("dict", flags=HEADER_TEXT_FLAGS)
+    header_spans = []
+    for block in text_dict["blocks"]:
+        if "lines" not in block or block["bbox"][1] > HEADER_LIMIT_Y:
+            continue
+        for line in block["lines"]:
+            for span in line["spans"]:
+                header_spans.append(span)
+
+    # Step 1: Find ALL label positions in the header for boundary detection
+    all_label_rects = []  # (rect, field_key)
+    label_hits = {}  # label_text -> hits, reused in step 2
+    for field_key, variants in FIELD_CONFIG:
+        for label in variants:
+            if label not in label_hits:
+                label_hits[label] = page.search_for(label)
+            for hit in label_hits[label]:
+                if hit.y0 <= HEADER_LIMIT_Y:
+                    all_label_rects.append((hit, field_key))
+
+    logger.info(f"Found {len(all_label_rects)} label positions in header area")
+    for lr, lk in all_label_rects:
+        logger.info(f"  Label '{lk}' at x={lr.x0:.0f}, y={lr.y0:.0f}")
+
+    # Step 2: For each user-provided field, find FIRST label match and replace its value
+    modifications = []
+    fields_done = set()
+
+    for field_key, label_variants in FIELD_CONFIG:
+        if field_key in fields_done:
+            continue
+        user_val = details.get(field_key)
+        if not user_val:
+            continue
+
+        for label_text in label_variants:
+            if field_key in fields_done:
+                break
+
+            hits = label_hits[label_text]
+            for hit in hits:
+                if hit.y0 > HEADER_LIMIT_Y or field_key in fields_done:
+                    continue
+
+                logger.info(f"  Matched '{label_text}' for field '{field_key}' at y={hit.y0:.0f}")
+
+                # Find right boundary: next label on same line, or page edge
+                right_bound = page_width
+                for other_rect, other_key in all_label_rects:
+                    if other_key == field_key:
+                        continue
+                    # Same horizontal band and to the right of our label
+                    if (abs(other_rect.y0 - hit.y0) < 10 and
+                        other_rect.x0 > hit.x1 + 5):
+                        right_bound = min(right_bound, other_rect.x0 - 2)
+
+                # Value area: rectangle from end of label to right boundary
+                val_rect = fitz.Rect(hit.x1, hit.y0 - 1, right_bound, hit.y1 + 1)
+
+                # Get existing text in value area to detect separator
+                existing = page.get_text("text", clip=val_rect).strip()
+
+                # Auto-detect separator (: or - or .)
+                sep = ": "
+                if existing:
+                    m = re.match(r'^(\s*[:\-\.]\s*)', existing)
+                    if m:
+                        sep = m.group(1)
+                        if not sep.endswith(' '):
+                            sep += ' '
+
+                # Find font info from nearest span in the value area
+                font_name = "helv"
+                font_size = 12
+                font_color = 0
+                font_flags = 0
+                baseline_y = hit.y1 - (hit.y1 - hit.y0) * 0.2
+
+                for sp in header_spans:
+                    sp_rect = fitz.Rect(sp["bbox"])
+                    if sp_rect.intersects(val_rect):
+                        font_name = sp["font"]
+                        font_size = sp["size"]
+                        font_color = sp["color"]
+                        font_flags = sp["flags"]
+                        baseline_y = sp["origin"][1]
+                        break
+
+                # Fallback: use the label's own font if nothing found in value area
+                if font_name == "helv":
+                    for sp in header_spans:
+                        sp_rect = fitz.Rect(sp["bbox"])
+                        if sp_rect.intersects(fitz.Rect(hit)):
+                            font_name = sp["font"]
+                            font_size = sp["size"]
+                            font_color = sp["color"]
+                            font_flags = sp["flags"]
+                            baseline_y = sp["origin"][1]
+                            break
+
+                modifications.append({
+                    'redact_rect': val_rect,
+                    'label_rect': hit,
+                    'label_text': label_text,
+                    'insert_x': hit.x1,
+                    'insert_y': baseline_y,
+                    'font': font_name,
+                    'size': font_size,
+                    'color': font_color,
+                    'flags': font_flags,
+                    'sep': sep,
+                    'user_val': user_val,
+                    'text': sep + user_val,
+                    'field_key': field_key,
+                })
+
+                logger.info(f"  >> Will replace {field_key}: '{existing}' -> '{sep}{user_val}'")
+                fields_done.add(field_key)
+                plan['replacements'] += 1
+                break  # First hit only for this label variant
+
+    if not modifications:
+        return plan
+
+    # Step 3: Group by line, then plan redactions and insertions with equal spacing for multi-field lines
+    from collections import defaultdict
+
+    # Group modifications by Y position (8pt tolerance for same line)
+    line_groups = defaultdict(list)
+    for mod in modifications:
+        y_key = round(mod['label_rect'].y0 / 8) * 8
+        line_groups[y_key].append(mod)
+
+    for y_key, group in sorted(line_groups.items()):
+        group.sort(key=lambda m: m['label_rect'].x0)
+
+        if len(group) == 1:
+            # Single field: redact just the value area
+            plan['redactions'].append(group[0]['redact_rect'])
+        else:
+            # Multiple fields on same line: redact entire line area (labels + values)
+            line_x0 = min(m['label_rect'].x0 for m in group)
+            line_x1 = max(m['redact_rect'].x1 for m in group)
+            line_y0 = min(m['label_rect'].y0 for m in group) - 1
+            line_y1 = max(m['label_rect'].y1 for m in group) + 1
+            plan['redactions'].append(fitz.Rect(line_x0, line_y0, line_x1, line_y1))
+
+        # Get font info from first field in the group
+        mod0 = group[0]
+        mapped_font = map_font(mod0['font'], mod0['flags'])
+        font_size = mod0['size']
+        c = mod0['color']
+        color = (((c >> 16) & 255) / 255, ((c >> 8) & 255) / 255, (c & 255) / 255)
+        baseline_y = mod0['insert_y']
+
+        if len(group) == 1:
+            # Single field: insert at original position
+            plan['inserts'].append(((mod0['insert_x'], mod0['insert_y']), mod0['text'], mapped_font, font_size, color))
+            continue
+
+        # Multiple fields: lay out with equal spacing
+        # Build text segments: "Label: Value"
+        segments = []
+        for mod in group:
+            seg_text = mod['label_text'] + mod['sep'] + mod['user_val']
+            try:
+                seg_width = fitz.get_text_length(seg_text, fontname=mapped_font, fontsize=font_size)
+            except:
+                seg_width = fitz.get_text_length(seg_text, fontname="helv", fontsize=font_size)
+                mapped_font = "helv"
+            segments.append((seg_text, seg_width, mod))
+
+        # Calculate equal gap spacing — capped to page margins
+        right_margin = page_width - 36  # 36pt = ~0.5 inch margin
+        line_x0 = min(m['label_rect'].x0 for m in group)
+        line_x1 = min(max(m['redact_rect'].x1 for m in group), right_margin)
+        total_line_width = line_x1 - line_x0
+        total_text_width = sum(w for _, w, _ in segments)
+
+        if len(segments) > 1 and total_line_width > total_text_width:
+            gap = (total_line_width - total_text_width) / (len(segments) - 1)
+        else:
+            gap = font_size * 2
+
+        gap = max(gap, font_size * 0.5)  # minimum half-em gap
+
+        # If everything would overflow the margin, shrink gap to fit
+        total_needed = total_text_width + gap * (len(segments) - 1)
+        if line_x0 + total_needed > right_margin and len(segments) > 1:
+            available = right_margin - line_x0 - total_text_width
+            gap = max(available / (len(segments) - 1), font_size * 0.3)
+
+        # Place each segment at calculated position
+        current_x = line_x0
+        for seg_text, seg_width, mod in segments:
+            plan['inserts'].append(((current_x, baseline_y), seg_text, mapped_font, font_size, color))
+            current_x += seg_width + gap
+
+    return plan
+
+
+def apply_header_plan(page, plan, stage_timings: Optional[dict] = None):
+    """Redact old values and insert new ones on a page according to a header plan."""
+    if not plan['redactions']:
+        return
+
+    with stage_timer(stage_timings, "redact"):
+        for rect in plan['redactions']:
+            page.add_redact_annot(rect, fill=(1, 1, 1))
+        page.apply_redactions()
+
+    with stage_timer(stage_timings, "insert"):
+        for point, text, fontname, fontsize, color in plan['inserts']:
+            try:
+                page.insert_text(point, text, fontname=fontname, fontsize=fontsize, color=color)
+            except Exception:
+                page.insert_text(point, text, fontname="helv", fontsize=fontsize, color=color)
+            logger.info(f"  Inserted '{text.strip()}' at x={point[0]:.0f}")
+
+
+def process_single_pdf(file_bytes, user_details, pages: Optional[str] = None, plan_cache: Optional[dict] = None,
+                       stage_timings: Optional[dict] = None):
+    """Process a single PDF: find field labels in page headers using native search, replace their values.
+
+    Only page 1 is personalized unless `pages` selects more (see parse_page_selection).
+    Further selected pages are personalized only when they repeat the header of the
+    first selected page (same header fingerprint); other pages, such as body pages
+    that merely mention "Name" or "Aim", are left untouched. Header plans are cached
+    by header fingerprint, so pages (and, when a shared plan_cache is passed, other
+    files) with an identical header skip the label search.
+    When stage_timings is a dict, seconds spent per PyMuPDF stage are added to it.
+    """
+    try:
+        with stage_timer(stage_timings, "open"):
+            doc = fitz.open(stream=file_bytes, filetype="pdf")
+        details = smart_parse_inputs(user_details)
+        logger.info(f"Processing PDF with details: {details}")
+
+        if plan_cache is None:
+            plan_cache = {}
+        replacements_made = 0
+        plans_computed = 0
+        pages_skipped = 0
+        header = None  # Fingerprint of the first selected page's header
+
+        page_numbers = parse_page_selection(pages, len(doc))
+        for page_number in page_numbers:
+            with stage_timer(stage_timings, "load_page"):
+                page = doc.load_page(page_number)  # Load only the selected pages, one at a time
+            with stage_timer(stage_timings, "fingerprint"):
+                fingerprint = header_fingerprint(page)
+            if header is None:
+                header = fingerprint
+            elif fingerprint != header:
+                pages_skipped += 1  # Not a repeat of the header, so label searches would hit body text
+                continue
+            plan = plan_cache.get(fingerprint)
+            if plan is None:
+                with stage_timer(stage_timings, "plan"):
+                    plan = plan_header(page, details)
+                plan_cache[fingerprint] = plan
+                plans_computed += 1
+            apply_header_plan(page, plan, stage_timings)
+            replacements_made += plan['replacements']
+
+        logger.info(f"Total replacements made: {replacements_made} "
+                    f"({len(page_numbers) - pages_skipped} pages, {plans_computed} header plans computed, "
+                    f"{pages_skipped} pages without the header skipped)")
+        if page_numbers and replacements_made == 0:
+            logger.warning("NO REPLACEMENTS MADE - no matching field labels found in the selected pages")
+
+        out_buffer = io.BytesIO()
+        with stage_timer(stage_timings, "save"):
+            if page_numbers:
+                doc.save(out_buffer, garbage=4, deflate=True, clean=True)
+            else:
+                doc.save(out_buffer)
+        doc.close()
+        out_buffer.seek(0)
+        pdf_bytes = out_buffer.getvalue()
+        logger.info(f"Returning PDF with {len(pdf_bytes)} bytes")
+        return pdf_bytes
+    except Exception as e:
+        logger.error(f"Error processing PDF: {e}")
+        import traceback
+        traceback.print_exc()
+        raise
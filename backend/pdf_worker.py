@@ -0,0 +1,206 @@
+"""Isolated worker processes that run PDF processing under per-document budgets.
+
+Only PyMuPDF and backend.pdf_processing are imported here, so workers stay small.
+The API process talks to each worker through a PdfWorker handle.
+"""
+from typing import Optional
+from collections import OrderedDict
+import re
+import time
+import signal
+import resource
+import logging
+
+import fitz  # PyMuPDF
+
+from backend.pdf_processing import new_job_profile, process_single_pdf, profile_single_pdf
+
+logger = logging.getLogger(__name__)
+
+PROCESSING_FAILED = "Could not process this PDF"  # Reason shown to users; details go to the server log
+PLAN_CACHE_JOBS = 8  # Jobs whose header plans each worker keeps (least recently used are dropped)
+
+# PyMuPDF's classic binding (1.23, as pinned) has no fitz.mupdf and raises RuntimeError;
+# the rebased one exposes fitz.mupdf, with FzErrorMemory in some releases. Allocation
+# failures inside MuPDF are otherwise only recognisable by their message, and a
+# MemoryError raised in a Python callback comes back wrapped as a "Director error"
+MEMORY_ERROR_TYPES = (MemoryError,) + tuple(
+    error_type for error_type in [getattr(getattr(fitz, "mupdf", None), "FzErrorMemory", None)]
+    if error_type is not None
+)
+MUPDF_MEMORY_ERROR = re.compile(
+    r"^(?:code=\d+: )?"  # Error code prefix of the rebased binding
+    r"(?:(?:m|c|re)alloc (?:of \d+ bytes|\(.*\)) failed"  # "malloc of N bytes failed" / "malloc (N bytes) failed"
+    r"|(?:zlib compression|deflateInit) failed: -4"  # zlib's Z_MEM_ERROR
+    r"|Director error: <class 'MemoryError'>)"
+)
+
+
+def is_memory_error(e: BaseException) -> bool:
+    """Whether e, or an exception it was raised from or while handling, is an out-of-memory failure."""
+    pending, seen = [e], set()
+    while pending:
+        error = pending.pop()
+        if error is None or id(error) in seen:
+            continue
+        seen.add(id(error))
+        if isinstance(error, MEMORY_ERROR_TYPES) or MUPDF_MEMORY_ERROR.match(str(error)):
+            return True
+        pending.extend([error.__cause__, error.__context__])
+    return False
+
+
+def current_address_space() -> int:
+    """Bytes of address space this process already uses (VmSize), 0 if unknown."""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmSize:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return 0
+
+
+def pdf_worker_main(conn, cpu_limit: int, memory_limit_mb: int, log_level: int = logging.INFO):
+    """Worker process loop: process one document per request under CPU and memory rlimits.
+
+    The memory budget is headroom on top of the idle worker's address space, so
+    memory_limit_mb is what a single document may use. The CPU soft limit is
+    re-armed before every document, so each one gets cpu_limit seconds; going
+    over raises SIGXCPU, which kills the worker.
+    """
+    logging.basicConfig(level=log_level)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # Shutdown is driven by the parent
+    resource.setrlimit(resource.RLIMIT_CORE, (0, 0))
+    if memory_limit_mb:
+        limit = current_address_space() + memory_limit_mb * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+    _, cpu_hard = resource.getrlimit(resource.RLIMIT_CPU)
+
+    plan_caches: "OrderedDict[str, dict]" = OrderedDict()  # cache_key -> {header fingerprint: plan}
+    while True:
+        try:
+            task = conn.recv()
+        except EOFError:
+            break
+        except MemoryError:
+            conn.send(("memory", f"Memory budget exceeded ({memory_limit_mb} MB)", None))
+            break
+        if task is None:
+            break
+
+        # Header plans are reused across the files of one job, even when files of
+        # other jobs are interleaved on this worker
+        plan_cache = {}
+        if task["cache_key"] is not None:
+            plan_cache = plan_caches.pop(task["cache_key"], plan_cache)
+            plan_caches[task["cache_key"]] = plan_cache
+            while len(plan_caches) > PLAN_CACHE_JOBS:
+                plan_caches.popitem(last=False)
+
+        if cpu_limit:
+            usage = resource.getrusage(resource.RUSAGE_SELF)
+            soft = int(usage.ru_utime + usage.ru_stime) + 1 + cpu_limit
+            if cpu_hard != resource.RLIM_INFINITY:
+                soft = min(soft, cpu_hard)
+            resource.setrlimit(resource.RLIMIT_CPU, (soft, cpu_hard))
+
+        part = new_job_profile() if task.get("profile") else None
+        try:
+            if part is not None:
+                result = profile_single_pdf(part, task["filename"], task["file_bytes"], task["user_profile"],
+                                            task["pages"], plan_cache)
+                conn.send(("ok", result, part))
+            else:
+                result = process_single_pdf(task["file_bytes"], task["user_profile"], task["pages"], plan_cache)
+                conn.send(("ok", result, None))
+        except Exception as e:
+            if is_memory_error(e):
+                status, reason = "memory", f"Memory budget exceeded ({memory_limit_mb} MB)"
+            else:
+                logger.error(f"Could not process {task['filename']}: {e}")
+                status, reason = "error", PROCESSING_FAILED
+            if part is not None and part["files"]:
+                part["files"][-1]["error"] = reason  # Keep what was sampled before the failure
+            conn.send((status, reason, part))
+            if status == "memory":
+                break  # Exit so the supervisor replaces this worker with a fresh heap
+
+
+def killed_profile(task: dict, started: float, reason: str) -> Optional[dict]:
+    """Profile part for a profiled task whose worker was killed before it could report."""
+    if not task.get("profile"):
+        return None
+    part = new_job_profile()
+    part["files"].append({
+        "filename": task["filename"],
+        "seconds": round(time.perf_counter() - started, 6),
+        "stage_timings": {},
+        "error": reason,
+    })
+    return part
+
+
+class PdfWorker:
+    """Handle on one worker process; run() blocks, so call it from a thread."""
+
+    def __init__(self, ctx, cpu_limit: int, memory_limit_mb: int):
+        self.cpu_limit = cpu_limit
+        self.memory_limit_mb = memory_limit_mb
+        self.conn, child_conn = ctx.Pipe()
+        self.process = ctx.Process(
+            target=pdf_worker_main,
+            args=(child_conn, cpu_limit, memory_limit_mb, logging.getLogger("backend").getEffectiveLevel()),
+            daemon=True,
+        )
+        self.process.start()
+        child_conn.close()
+
+    @property
+    def pid(self) -> Optional[int]:
+        return self.process.pid
+
+    def is_alive(self) -> bool:
+        return self.process.is_alive()
+
+    def run(self, task: dict, timeout: float) -> tuple:
+        """Send one task and wait for ("ok" | "error" | "memory" | "cpu" | "timeout" | "crash", payload, profile).
+
+        When the task is profiled and the worker is killed, the profile only
+        records the file, its wall time and the kill reason.
+        """
+        started = time.perf_counter()
+        try:
+            self.conn.send(task)
+            if not self.conn.poll(timeout):
+                self.kill()
+                reason = f"Processing took longer than {timeout:.0f}s"
+                return ("timeout", reason, killed_profile(task, started, reason))
+            result = self.conn.recv()
+            if result[0] == "memory":
+                self.process.join(1)  # Worker exits after a memory failure; let it finish before respawning
+            return result
+        except (EOFError, OSError):
+            self.process.join(1)
+            exitcode = self.process.exitcode
+            if exitcode == -signal.SIGXCPU:
+                reason = f"CPU budget exceeded ({self.cpu_limit}s)"
+                return ("cpu", reason, killed_profile(task, started, reason))
+            # Anything else, including SIGKILL from the kernel OOM killer, is a crash
+            logger.error(f"PDF worker {self.pid} died (exit code {exitcode})")
+            return ("crash", PROCESSING_FAILED, killed_profile(task, started, PROCESSING_FAILED))
+
+    def kill(self):
+        if self.process.is_alive():
+            self.process.kill()
+        self.process.join(1)
+        self.conn.close()
+
+    def stop(self):
+        try:
+            self.conn.send(None)
+        except OSError:
+            pass
+        self.process.join(2)
+        self.kill()
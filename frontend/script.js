@@ -11,6 +11,9 @@ const MAX_FILE_SIZE = 10 * 1024 * 1024; // 10MB
 const MAX_FILES = 20;
 const STATUS_POLL_INTERVAL = 2000; // 2 seconds
 
+// Job currently being polled, so it can be cancelled if the tab is closed
+let activeJobId = null;
+
 // Utility Functions
 function showError(message) {
     errorMessage.textContent = message;
@@ -143,14 +146,19 @@ async function pollJobStatus(jobId) {
                 const url = window.URL.createObjectURL(blob);
                 const a = document.createElement('a');
                 a.href = url;
-                a.download = "processed_lab_reports.zip";
+                a.download = status.filename || "processed_lab_reports.zip";
                 document.body.appendChild(a);
                 a.click();
                 window.URL.revokeObjectURL(url);
                 a.remove();
 
                 loadingOverlay.classList.add('hidden');
-                showSuccess('Files processed successfully! Download started.');
+                if (status.failed_files && status.failed_files.length > 0) {
+                    const skipped = status.failed_files.map(f => `${f.filename} (${f.reason})`).join(', ');
+                    showSuccess(`Download started. Skipped ${status.failed_files.length} file(s): ${skipped}`);
+                } else {
+                    showSuccess('Files processed successfully! Download started.');
+                }
 
                 // Update stats
                 fetchStats();
@@ -165,6 +173,10 @@ async function pollJobStatus(jobId) {
                 loadingOverlay.classList.add('hidden');
                 showError(status.error || 'Processing failed. Please try again.');
                 break;
+            } else if (status.status === 'cancelled') {
+                loadingOverlay.classList.add('hidden');
+                showError(status.message || 'Job was cancelled. Please try again.');
+                break;
             }
 
             // Wait before polling again
@@ -233,7 +245,7 @@ uploadForm.addEventListener('submit', async (e) => {
     // Check if at least one field is filled
     const formData = new FormData(uploadForm);
     const hasData = Array.from(formData.entries()).some(([key, value]) =>
-        key !== 'files' && value.trim() !== ''
+        !['files', 'pages', 'output'].includes(key) && value.trim() !== ''
     );
 
     if (!hasData) {
@@ -264,11 +276,22 @@ uploadForm.addEventListener('submit', async (e) => {
         updateLoadingMessage(`Added to queue. Position: #${result.position}`);
 
         // Start polling for status
+        activeJobId = jobId;
         await pollJobStatus(jobId);
+        activeJobId = null;
 
     } catch (error) {
         console.error('Error:', error);
+        activeJobId = null;
         loadingOverlay.classList.add('hidden');
         showError(error.message || 'Failed to connect to the server. Please try again.');
     }
 });
+
+// Free the server slot if the user leaves while a job is still pending.
+// Skip pages kept in the back/forward cache - they resume polling when the user comes back.
+window.addEventListener('pagehide', (event) => {
+    if (activeJobId && !event.persisted) {
+        fetch(`/api/jobs/${activeJobId}`, { method: 'DELETE', keepalive: true });
+    }
+});
@@ -0,0 +1,16 @@
+import asyncio
+
+import pytest
+
+import backend.main as app_main
+
+
+@pytest.fixture
+def app_loop_state(monkeypatch):
+    """Fresh queue and pool condition for a test that runs the app in its own event loop.
+
+    asyncio primitives bind to the first loop that waits on them, and each test
+    runs the app under a new asyncio.run().
+    """
+    monkeypatch.setattr(app_main, "job_queue", asyncio.Queue())
+    monkeypatch.setattr(app_main, "pdf_workers_available", asyncio.Condition())
@@ -0,0 +1,77 @@
+import asyncio
+
+import fitz  # PyMuPDF
+import httpx
+
+import backend.main as app_main
+from backend.loadtest import make_synthetic_pdf
+
+
+async def wait_for_job(client: httpx.AsyncClient, job_id: str) -> dict:
+    while True:
+        status = (await client.get(f"/api/status/{job_id}")).json()
+        if status["status"] not in ["queued", "processing"]:
+            return status
+        await asyncio.sleep(0.05)
+
+
+def test_queue_rejects_unreadable_pdfs_in_the_worker(app_loop_state):
+    files = [
+        ("files", ("good.pdf", make_synthetic_pdf(50), "application/pdf")),
+        ("files", ("broken.pdf", b"%PDF-1.4\n" + b"\x00garbage" * 1000, "application/pdf")),
+        ("files", ("notes.pdf", b"just some text", "application/pdf")),
+    ]
+
+    async def run():
+        async with app_main.lifespan(app_main.app):
+            transport = httpx.ASGITransport(app=app_main.app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://test", timeout=60) as client:
+                response = await client.post("/api/queue", files=files, data={"name": "Test Student"})
+                assert response.status_code == 200
+                status = await wait_for_job(client, response.json()["job_id"])
+
+                # No %PDF header: dropped at upload. Header but unreadable: failed by the worker
+                assert status["status"] == "completed"
+                assert status["failed_files"] == [{"filename": "broken.pdf", "reason": app_main.PROCESSING_FAILED}]
+
+                response = await client.post("/api/queue", files=files[2:], data={"name": "Test Student"})
+                assert response.status_code == 400
+
+    asyncio.run(run())
+
+
+def make_slow_pdf(pages: int = 60) -> bytes:
+    """A text-heavy document that keeps a worker busy for a while with pages=all."""
+    doc = fitz.open()
+    for i in range(pages):
+        page = doc.new_page()
+        page.insert_text((50, 60), "Name: Old Student", fontsize=12)
+        for k in range(40):
+            page.insert_text((50, 100 + k * 15), f"Roll No: {i} observation {k}", fontsize=10)
+    pdf_bytes = doc.tobytes()
+    doc.close()
+    return pdf_bytes
+
+
+def test_deleting_a_cancelled_job_with_a_file_in_flight(app_loop_state, caplog):
+    files = [("files", (f"report_{i}.pdf", make_slow_pdf(), "application/pdf")) for i in range(2)]
+
+    async def run():
+        async with app_main.lifespan(app_main.app):
+            transport = httpx.ASGITransport(app=app_main.app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://test", timeout=60) as client:
+                response = await client.post("/api/queue", files=files, data={"name": "Test Student", "pages": "all"})
+                job_id = response.json()["job_id"]
+                while (await client.get(f"/api/status/{job_id}")).json()["status"] != "processing":
+                    await asyncio.sleep(0.01)
+
+                assert (await client.delete(f"/api/jobs/{job_id}")).json()["status"] == "cancelled"
+                assert (await client.delete(f"/api/jobs/{job_id}")).json()["status"] == "deleted"
+                assert (await client.get(f"/api/status/{job_id}")).status_code == 404
+
+                while app_main.active_jobs:  # The in-flight file finishes, then the job stops
+                    await asyncio.sleep(0.05)
+
+    asyncio.run(run())
+    assert "Failed with error" not in caplog.text
+    assert "Stopped after cancellation" in caplog.text
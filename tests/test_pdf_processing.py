@@ -0,0 +1,99 @@
+import fitz  # PyMuPDF
+import pytest
+
+import backend.pdf_processing as pdf_processing
+from backend.pdf_processing import header_fingerprint, parse_page_selection, process_single_pdf
+
+BODY_LINES = [
+    "The aim of this experiment is to measure the speed of sound.",
+    "Section 2 describes the apparatus and the class of errors involved.",
+]
+
+
+def make_report(page_kinds) -> bytes:
+    """A PDF with one page per entry: "header" pages repeat the report header, "body" pages hold plain text."""
+    doc = fitz.open()
+    for kind in page_kinds:
+        page = doc.new_page()
+        if kind == "header":
+            page.insert_text((50, 60), "Name: Old Student", fontsize=12)
+            page.insert_text((50, 80), "Roll No: 00", fontsize=12)
+            page.insert_text((300, 80), "Div: A", fontsize=12)
+        else:
+            for i, line in enumerate(BODY_LINES):
+                page.insert_text((50, 100 + 20 * i), line, fontsize=11)
+    pdf_bytes = doc.tobytes()
+    doc.close()
+    return pdf_bytes
+
+
+def page_texts(pdf_bytes: bytes) -> list:
+    with fitz.open(stream=pdf_bytes, filetype="pdf") as doc:
+        return [page.get_text() for page in doc]
+
+
+DETAILS = {"name": "New Student", "roll": "42", "div": "B", "activity": "Exp 3", "class": "SE"}
+
+
+@pytest.mark.parametrize("spec, page_count, expected", [
+    (None, 5, [0]),
+    ("", 5, [0]),
+    ("", 0, []),
+    ("all", 3, [0, 1, 2]),
+    (" ALL ", 2, [0, 1]),
+    ("2", 5, [1]),
+    ("1-3,5", 5, [0, 1, 2, 4]),
+    ("3, 1-2, 2", 5, [0, 1, 2]),
+    ("2-10", 4, [1, 2, 3]),
+    ("7", 4, []),
+])
+def test_parse_page_selection(spec, page_count, expected):
+    assert parse_page_selection(spec, page_count) == expected
+
+
+@pytest.mark.parametrize("spec", ["0", "3-1", "a", "1-", "1;2"])
+def test_parse_page_selection_rejects_invalid_specs(spec):
+    with pytest.raises(ValueError):
+        parse_page_selection(spec, 5)
+
+
+def test_all_pages_personalizes_repeated_headers_only():
+    result = process_single_pdf(make_report(["header", "body", "header"]), DETAILS, pages="all")
+
+    first, body, last = page_texts(result)
+    for text in (first, last):
+        assert "New Student" in text and "42" in text
+        assert "Old Student" not in text
+    for line in BODY_LINES:
+        assert line in body
+    assert "New Student" not in body and "Exp 3" not in body
+
+
+def test_pages_with_same_header_share_one_plan(monkeypatch):
+    calls = []
+    plan_header = pdf_processing.plan_header
+
+    def counting_plan_header(page, details):
+        calls.append(page.number)
+        return plan_header(page, details)
+
+    monkeypatch.setattr(pdf_processing, "plan_header", counting_plan_header)
+
+    plan_cache = {}
+    process_single_pdf(make_report(["header"] * 3), DETAILS, pages="all", plan_cache=plan_cache)
+    assert calls == [0]
+    assert len(plan_cache) == 1
+
+    # Another file of the same job reuses the plan through the shared cache
+    result = process_single_pdf(make_report(["header"] * 2), DETAILS, pages="all", plan_cache=plan_cache)
+    assert calls == [0]
+    assert all("New Student" in text for text in page_texts(result))
+
+
+def test_header_fingerprint_ignores_body_text():
+    with fitz.open(stream=make_report(["header", "header"]), filetype="pdf") as doc:
+        doc[1].insert_text((50, 300), "Observations differ on every page", fontsize=11)
+        assert header_fingerprint(doc[0]) == header_fingerprint(doc[1])
+
+    with fitz.open(stream=make_report(["header", "body"]), filetype="pdf") as doc:
+        assert header_fingerprint(doc[0]) != header_fingerprint(doc[1])
@@ -0,0 +1,98 @@
+import asyncio
+import re
+
+import pytest
+
+import backend.main as app_main
+from backend.loadtest import make_synthetic_pdf
+from backend.pdf_worker import fitz, is_memory_error
+
+
+@pytest.mark.parametrize("message", [
+    "malloc of 8187313 bytes failed",  # PyMuPDF 1.23
+    "realloc (82380 bytes) failed",
+    "zlib compression failed: -4",
+    "code=2: malloc (8187313 bytes) failed",  # Rebased binding
+    "code=1: Director error: <class 'MemoryError'>: <C_nullptr>\nTraceback ...",
+])
+def test_is_memory_error_detects_mupdf_allocation_failures(message):
+    assert is_memory_error(RuntimeError(message))
+    mupdf = getattr(fitz, "mupdf", None)
+    if mupdf is not None:
+        assert is_memory_error(mupdf.FzErrorGeneric(re.sub(r"^code=\d+: ", "", message)))  # Adds its own code
+
+
+def test_is_memory_error_follows_cause_and_context():
+    assert not is_memory_error(RuntimeError("code=2: cannot open file 'x.pdf'"))
+    assert not is_memory_error(RuntimeError("cannot find page 3 of 'x.pdf'"))
+
+    try:
+        try:
+            raise MemoryError
+        except MemoryError:
+            raise ValueError("while handling")
+    except ValueError as e:
+        assert is_memory_error(e)
+
+    wrapped = RuntimeError("failed")
+    wrapped.__cause__ = MemoryError()
+    assert is_memory_error(wrapped)
+
+
+def test_memory_budget_kills_and_respawns_worker(monkeypatch):
+    monkeypatch.setattr(app_main, "FILE_MEMORY_LIMIT_MB", 20)
+    pdf_bytes = make_synthetic_pdf(8000)
+    profile = {"name": "Test Student", "roll": "1"}
+
+    async def run():
+        await app_main.stop_pdf_workers()  # Start from workers with the low budget
+        worker = await app_main.acquire_pdf_worker()
+        old_pid = worker.pid
+        await app_main.release_pdf_worker(worker)
+        before = dict(app_main.watchdog_stats)
+
+        try:
+            with pytest.raises(app_main.DocumentProcessingError):
+                await app_main.process_pdf_isolated("big.pdf", pdf_bytes, profile)
+
+            assert app_main.watchdog_stats["memory_limit_kills"] == before["memory_limit_kills"] + 1
+            assert app_main.watchdog_stats["worker_respawns"] == before["worker_respawns"] + 1
+            assert app_main.watchdog_stats["worker_crashes"] == before["worker_crashes"]
+
+            worker = await app_main.acquire_pdf_worker()
+            assert worker.pid != old_pid and worker.is_alive()
+            await app_main.release_pdf_worker(worker)
+
+            # The replacement worker still processes documents that fit the budget
+            assert await app_main.process_pdf_isolated("small.pdf", make_synthetic_pdf(50), profile)
+        finally:
+            await app_main.stop_pdf_workers()
+
+    asyncio.run(run())
+
+
+def test_failed_respawn_frees_the_worker_slot(monkeypatch, app_loop_state):
+    monkeypatch.setattr(app_main, "PDF_WORKERS", 1)
+    start_pdf_worker = app_main.start_pdf_worker
+
+    def failing_start():
+        raise OSError("fork failed")
+
+    async def run():
+        await app_main.stop_pdf_workers()
+        try:
+            worker = await app_main.acquire_pdf_worker()
+            worker.kill()  # Dies while busy, e.g. at its wall timeout
+
+            monkeypatch.setattr(app_main, "start_pdf_worker", failing_start)
+            await app_main.release_pdf_worker(worker)
+
+            # The slot is free again, so the next acquire starts a new worker instead of waiting forever
+            monkeypatch.setattr(app_main, "start_pdf_worker", start_pdf_worker)
+            worker = await asyncio.wait_for(app_main.acquire_pdf_worker(), timeout=30)
+            assert worker.is_alive()
+            await app_main.release_pdf_worker(worker)
+        finally:
+            await app_main.stop_pdf_workers()
+
+    asyncio.run(run())
@@ -0,0 +1,84 @@
+import asyncio
+import json
+from collections import Counter
+
+import httpx
+import pytest
+
+import backend.main as app_main
+from backend.loadtest import make_synthetic_pdf
+from backend.pdf_processing import new_job_profile, profile_single_pdf
+
+ADMIN_TOKEN = "test-admin-token"
+
+
+def test_samples_are_weighted_by_measured_time():
+    # Saving a large document is one long MuPDF call that holds the GIL, so the
+    # sampler gets only a few samples in; their weights must still add up to it
+    profile = new_job_profile()
+    profile_single_pdf(profile, "big.pdf", make_synthetic_pdf(6000), {"name": "Test Student"}, None, {})
+
+    wall = profile["files"][0]["seconds"]
+    sampled = sum(profile["stack_seconds"].values())
+    assert sum(profile["stacks"].values()) >= 1
+    assert 0.8 * wall <= sampled <= wall + profile["interval"]
+    slowest_stack = profile["stack_seconds"].most_common(1)[0][0]
+    assert "save" in slowest_stack
+
+
+def test_profile_to_speedscope_uses_measured_weights():
+    profile = new_job_profile()
+    profile["stacks"] = Counter({"process_single_pdf;save": 1, "process_single_pdf;plan_header": 3})
+    profile["stack_seconds"] = Counter({"process_single_pdf;save": 0.2, "process_single_pdf;plan_header": 0.015})
+
+    speedscope = app_main.profile_to_speedscope("job", profile)
+
+    frames = [frame["name"] for frame in speedscope["shared"]["frames"]]
+    assert frames == ["process_single_pdf", "save", "plan_header"]
+    sampled = speedscope["profiles"][0]
+    assert sampled["samples"] == [[0, 1], [0, 2]]
+    assert sampled["weights"] == [0.2, 0.015]
+    assert sampled["endValue"] == pytest.approx(0.215)
+
+
+def test_admin_profile_endpoint(monkeypatch, app_loop_state):
+    monkeypatch.setattr(app_main, "ADMIN_TOKEN", ADMIN_TOKEN)
+    admin = {"X-Admin-Token": ADMIN_TOKEN}
+
+    async def run():
+        async with app_main.lifespan(app_main.app):
+            transport = httpx.ASGITransport(app=app_main.app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://test", timeout=60) as client:
+                files = [("files", (f"report_{i}.pdf", make_synthetic_pdf(300, seed=i), "application/pdf")) for i in range(2)]
+                data = {"name": "Test Student", "profile": "true"}
+
+                response = await client.post("/api/queue", files=files, data=data)
+                assert response.status_code == 403
+
+                response = await client.post("/api/queue", files=files, data=data, headers=admin)
+                job_id = response.json()["job_id"]
+                while (await client.get(f"/api/status/{job_id}")).json()["status"] not in ["completed", "failed"]:
+                    await asyncio.sleep(0.05)
+
+                url = f"/api/admin/jobs/{job_id}/profile"
+                assert (await client.get(url)).status_code == 403
+                assert (await client.get(url, headers={"X-Admin-Token": "wrong"})).status_code == 403
+                assert (await client.get("/api/admin/jobs/unknown/profile", headers=admin)).status_code == 404
+                assert (await client.get(url, params={"format": "svg"}, headers=admin)).status_code == 400
+
+                summary = (await client.get(url, headers=admin)).json()
+                assert summary["status"] == "completed"
+                assert [f["filename"] for f in summary["files"]] == ["report_0.pdf", "report_1.pdf"]
+                assert set(summary["stage_timings"]) >= {"open", "fingerprint", "save"}
+                assert summary["samples"] >= 1
+
+                collapsed = (await client.get(url, params={"format": "collapsed"}, headers=admin)).text
+                weights = [int(line.rsplit(" ", 1)[1]) for line in collapsed.splitlines()]
+                assert abs(sum(weights) / 1e6 - summary["sampled_seconds"]) < 0.001
+
+                response = await client.get(url, params={"format": "speedscope"}, headers=admin)
+                assert "attachment" in response.headers["content-disposition"]
+                speedscope = json.loads(response.content)
+                assert abs(speedscope["profiles"][0]["endValue"] - summary["sampled_seconds"]) < 0.001
+
+    asyncio.run(run())